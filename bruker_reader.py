@@ -0,0 +1,131 @@
+import os
+import re
+import numpy as np
+from ingestion import ingest
+
+# Native reader for Bruker flex acquisitions (the "fid" + "acqus" pairs that
+# MALDIquantForeign::importBrukerFlex reads), so raw spectra can be loaded
+# without going through R.
+
+ACQUS_FIELD = re.compile(r"^##\$?([^=]+)=\s*(.*)$")
+
+
+def read_acqus(path):
+    """Parse a Bruker acqus (JCAMP-DX) file into a dict.
+
+    Numeric values are converted to float/int; everything else is kept as a
+    string with the surrounding "<>" removed.
+    """
+    acqus = {}
+    with open(path, errors="ignore") as handle:
+        for line in handle:
+            match = ACQUS_FIELD.match(line.strip())
+            if match is None:
+                continue
+            key, value = match.group(1).strip(), match.group(2).strip()
+            if value.startswith("<") and value.endswith(">"):
+                acqus[key] = value[1:-1]
+                continue
+            try:
+                number = float(value)
+            except ValueError:
+                acqus[key] = value
+                continue
+            acqus[key] = int(number) if number.is_integer() else number
+    return acqus
+
+
+def tof2mass(tof, ml1, ml2, ml3):
+    """Quadratic time-of-flight to m/z calibration used by Bruker flex."""
+    a = ml3
+    b = np.sqrt(1e12 / ml1)
+    c = ml2 - tof
+    if a == 0:
+        return (c * c) / (b * b)
+    return ((-b + np.sqrt((b * b) - (4 * a * c))) / (2 * a)) ** 2
+
+
+def mass_axis(acqus):
+    """m/z of every point of the acquisition described by an acqus dict."""
+    tof = acqus["DELAY"] + np.arange(acqus["TD"]) * acqus["DW"]
+    return tof2mass(tof, acqus["ML1"], acqus["ML2"], acqus["ML3"])
+
+
+# Sample type (DTYPA) and byte order (BYTORDA) of a fid, as stored in acqus
+FID_TYPES = {0: "i4", 2: "f8"}
+FID_BYTEORDERS = {0: "<", 1: ">"}
+
+
+def open_fid(path, acqus):
+    """Memory-map a fid file, without reading it.
+
+    The dtype follows DTYPA (0: int32, 2: float64) and the byte order
+    BYTORDA (0: little endian, 1: big endian); both default to 0 when the
+    field is missing. Other values raise a ValueError.
+    """
+    dtypa, bytorda = acqus.get("DTYPA", 0), acqus.get("BYTORDA", 0)
+    if dtypa not in FID_TYPES:
+        raise ValueError("Unsupported DTYPA " + str(dtypa) + " in " + path)
+    if bytorda not in FID_BYTEORDERS:
+        raise ValueError("Unsupported BYTORDA " + str(bytorda) + " in " + path)
+    dtype = np.dtype(FID_BYTEORDERS[bytorda] + FID_TYPES[dtypa])
+    n_points = min(acqus["TD"], os.path.getsize(path) // dtype.itemsize)
+    return np.memmap(path, dtype=dtype, mode="r", shape=(n_points,))
+
+
+def read_bruker_flex(folder):
+    """Read one acquisition folder (the one holding "fid" and "acqus").
+
+    Returns
+    -------
+    __mass: array (shape = [TD,]).
+        m/z axis computed from the acqus calibration constants.
+    __intensity: array (shape = [TD,]).
+        Raw intensities as float64.
+    __metadata: dict.
+        acqus fields plus "file" (the path of the fid).
+    """
+    acqus = read_acqus(os.path.join(folder, "acqus"))
+    fid = open_fid(os.path.join(folder, "fid"), acqus)
+    mass = mass_axis(acqus)[: fid.shape[0]]
+    intensity = np.asarray(fid, dtype=np.float64)
+    acqus["file"] = os.path.join(folder, "fid")
+    return mass, intensity, acqus
+
+
+def find_acquisitions(path):
+    """All folders below path that contain an acquisition (fid + acqus)."""
+    folders = []
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        if "fid" in filenames and "acqus" in filenames:
+            folders.append(dirpath)
+    return folders
+
+
+def read_bruker_tree(path, n_jobs=None, chunksize=16):
+    """Read every acquisition below path with a pool of worker processes.
+
+    The output keeps the (sorted) directory order of the tree. Acquisitions
+    that cannot be read are reported and skipped.
+
+    Parameters
+    ----------
+    __path: str.
+        Root folder, e.g. a hospital upload with one sub-folder per sample.
+    __n_jobs: int, (default None).
+        Number of worker processes, all cores if None. 1 reads serially.
+    __chunksize: int, (default 16).
+        Number of folders sent to a worker at a time.
+
+    Returns lists of masses, intensities and metadata dicts.
+    """
+    folders = find_acquisitions(path)
+    spectra, failed = ingest(
+        folders, reader=read_bruker_flex, n_jobs=n_jobs, chunksize=chunksize
+    )
+    spectra = [spectrum for spectrum in spectra if spectrum is not None]
+    masses = [spectrum[0] for spectrum in spectra]
+    intensities = [spectrum[1] for spectrum in spectra]
+    metadata = [spectrum[2] for spectrum in spectra]
+    return masses, intensities, metadata
@@ -0,0 +1,77 @@
+import argparse
+import os
+import sys
+import numpy as np
+from bruker_reader import read_bruker_tree
+from maldi_preprocess import read_processed_csv, compare_with_r
+
+# Check maldi_preprocess.preprocess against preprocess_maldi.R: the same raw
+# Bruker acquisitions are read natively and preprocessed in Python, and the
+# result is compared with the CSVs the R script exported for them.
+
+
+def match_spectra(metadata, r_ids):
+    """Index of the R export of every raw acquisition (None if missing).
+
+    preprocess_maldi.R names each CSV after a folder of the fid path, so an
+    acquisition matches the export whose name is one of its path components.
+    """
+    r_index = {r_id: i for i, r_id in enumerate(r_ids)}
+    matches = []
+    for meta in metadata:
+        found = None
+        for component in meta["file"].split(os.sep):
+            if component in r_index:
+                found = r_index[component]
+        matches.append(found)
+    return matches
+
+
+def main(raw_path, r_path, rtol=1e-6, atol=1e-12):
+    """Compare every raw acquisition below raw_path with its R export.
+
+    Returns True if every matched spectrum agrees within the tolerances.
+    """
+    masses, intensities, metadata = read_bruker_tree(raw_path)
+    r_masses, r_intensities, r_ids = read_processed_csv(r_path)
+    matches = match_spectra(metadata, r_ids)
+
+    n_checked = 0
+    agree = True
+    for mass, intensity, meta, j in zip(masses, intensities, metadata, matches):
+        if j is None:
+            print("No R export for " + meta["file"])
+            continue
+        if len(r_intensities[j]) != len(intensity) or not np.allclose(
+            r_masses[j], mass, rtol=rtol
+        ):
+            print("Different m/z axis for " + r_ids[j])
+            agree = False
+            continue
+        errors = compare_with_r(intensity, mass, r_intensities[j], rtol, atol)
+        n_checked += 1
+        if not errors["allclose"]:
+            agree = False
+        print(
+            r_ids[j],
+            "max abs error:",
+            errors["max_abs_error"][0],
+            "max rel error:",
+            errors["max_rel_error"][0],
+        )
+    print(n_checked, "spectra checked,", "agree" if agree else "MISMATCH")
+    return agree
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("raw", type=str, help="Folder with the raw Bruker data")
+    parser.add_argument(
+        "r_export", type=str, help="Folder with the CSVs of preprocess_maldi.R"
+    )
+    parser.add_argument("--rtol", type=float, default=1e-6)
+    parser.add_argument("--atol", type=float, default=1e-12)
+    args = parser.parse_args()
+
+    # python check_preprocess.py raw_data/ processed_R/
+    sys.exit(0 if main(args.raw, args.r_export, args.rtol, args.atol) else 1)
@@ -11,6 +11,7 @@ from sklearn.metrics import r2_score, auc, roc_curve
 import multiprocessing as mp
 import math
 import scipy as sc
+from scipy.special import expit
 
 class LR_ARD(object):
     def __init__(self):
@@ -26,7 +27,6 @@ class LR_ARD(object):
         self.t = y
         self.fact_sel = np.arange(self.z.shape[1])
         #self.K_tr = self.center_K(self.z @ self.z.T)
-        self.K_tr = self.z @ self.z.T
         
         self.K = self.z.shape[1] #num dimensiones input
         self.D = self.t.shape[1] #num dimensiones output
@@ -37,9 +37,7 @@ class LR_ARD(object):
         # Some precomputed matrices
         #self.ZTZ = self.z.T @ self.z  #(KxK) es enorme, habría que ver si se puede evitar este calculo
         #self.YTZ = self.y.T @ self.z  #(DxK) 
-        self.KTK = self.K_tr.T @ self.K_tr
-        self.KTY = self.K_tr.T @ self.y
-        self.YTK = self.t.T @ self.K_tr
+        self.update_gram()
         self.L = []
         self.mse = []
         self.mse_tst = []        
@@ -57,6 +55,7 @@ class LR_ARD(object):
         self.q_dist = Qdistribution(self.N, self.D, self.K, self.hyper)
 
         self.fit_vb(prune, maxit, pruning_crit, tol)
+        self.dual_posterior()
         
         
     def center_K(self, K):
@@ -71,22 +70,78 @@ class LR_ARD(object):
         E = D2.sum(axis=0)/size_1
         return K + np.tile(E,[size_1,size_2]) - np.tile(D1,[size_1,1]) - np.tile(D2,[size_2,1]).T
 
+    def update_gram(self):
+        """Kernel and Gram products of the current inputs.
+        
+        They only depend on z, so they are computed once and kept until
+        pruning drops features. This is also where the formulation is
+        chosen: the dual (posterior of A, NxN systems) while there are more
+        features than samples, the primal (posterior of the weights
+        w = z.T @ A, KxK systems) once there are fewer.
+        """
+        primal = self.z.shape[1] < self.N
+        if primal and not getattr(self, 'primal', False):
+            print('Switching to the primal formulation: %d features, %d samples' %(self.z.shape[1], self.N))
+        self.primal = primal
+        if self.primal:
+            self.ZTZ = self.z.T @ self.z
+            self.ZTZ_logdet = np.linalg.slogdet(self.ZTZ)[1]
+        else:
+            self.K_tr = self.z @ self.z.T
+            self.KTK = self.K_tr.T @ self.K_tr
+            self.KTY = self.K_tr.T @ self.y
+            self.YTK = self.t.T @ self.K_tr
+
+    def w_mean(self):
+        """Posterior mean of the weights w = z.T @ A."""
+        q = self.q_dist
+        if self.primal:
+            return q.W['mean']
+        return self.z.T @ q.A['mean']
+
+    def dual_posterior(self):
+        """Map the primal posterior of the weights back to A.
+        
+        With fewer features than samples, A = z @ inv(z.T @ z) @ w is the
+        posterior the dual (pseudo-inverse) solution would give, so the
+        prediction methods keep working on A['mean'] and A['cov'].
+        """
+        q = self.q_dist
+        if not self.primal:
+            return
+        P = self.z @ self.myInverse(self.ZTZ)
+        q.A['mean'] = P @ q.W['mean']
+        q.A['cov'] = P @ q.W['cov'] @ P.T
+        q.A['prodT'] = q.A['mean'] @ q.A['mean'].T + q.A['cov']
+
 
     def pruning(self, pruning_crit):
         q = self.q_dist
+        w = self.w_mean()
         
-        maximo = np.max(abs(self.z.T @ q.A['mean']))
+        maximo = np.max(abs(w))
         
-        self.fact_sel = np.arange(self.z.shape[1])[(abs(self.z.T @ q.A['mean']) > maximo*pruning_crit).flatten()].astype(int)
+        self.fact_sel = np.arange(self.z.shape[1])[(abs(w) > maximo*pruning_crit).flatten()].astype(int)
         
         aux = self.input_idx[self.input_idx]
         aux[self.fact_sel] = False
         self.input_idx[self.input_idx] = ~aux
         
         
+        was_primal = self.primal
         self.z = self.z[:,self.fact_sel]
         self.z_tst = self.z_tst[:,self.fact_sel]
-        self.K_tr = self.z @ self.z.T
+        self.update_gram()
+        if self.primal:
+            if was_primal:
+                # Marginal posterior of the kept weights
+                q.W['mean'] = q.W['mean'][self.fact_sel]
+                q.W['cov'] = q.W['cov'][np.ix_(self.fact_sel, self.fact_sel)]
+            else:
+                # Just switched: weights of the dual posterior of A
+                q.W['mean'] = self.z.T @ q.A['mean']
+                q.W['cov'] = self.z.T @ q.A['cov'] @ self.z
+            q.W['prodT'] = q.W['mean'] @ q.W['mean'].T + q.W['cov']
         q.alpha['a'] = q.alpha['a'][self.fact_sel]
         q.alpha['b'] = q.alpha['b'][self.fact_sel]
         self.hyper.alpha_a = self.hyper.alpha_a[self.fact_sel]
@@ -143,31 +198,40 @@ class LR_ARD(object):
             Z_test = self.z_tst
         return Z_test @ self.z.T @ q.A['mean']
     
-    def predict_proba(self, Z_test):
+    def predictive(self, Z_test, z, a_mean, a_cov, tau):
+        """Predictive mean and variance of all the rows of Z_test at once.
+        
+        The rows are projected on the training inputs with one product and
+        the variances tau + k_i @ a_cov @ k_i.T are a row-wise contraction,
+        instead of a loop over the samples.
+        
+        Returns the mean and the variance (shape = [n_samples, 1] each).
+        """
+        proj = Z_test @ z.T
+        mean = proj @ a_mean
+        sig = tau + np.einsum('in,in->i', proj @ a_cov, proj)[:, np.newaxis]
+        return mean, sig
+    
+    def batch_proba(self, Z_test, z = None):
+        """Probabilities of all the rows of Z_test (shape = [n_samples, 1])."""
         q = self.q_dist
-        probs = np.zeros((np.shape(Z_test)[0],1))
-        for i in range(np.shape(Z_test)[0]):
-            mean = Z_test[np.newaxis,i,:] @ self.z.T @ q.A['mean']
-            sig = q.tau_mean() + Z_test[np.newaxis,i,:] @ self.z.T @ q.A['cov'] @ self.z @ Z_test[np.newaxis,i,:].T
-            prob = self.sigmoid(mean/(np.sqrt(1+(np.pi/8)*sig)))
-            probs[i,0] = prob
-        return probs
+        if z is None:
+            z = self.z
+        mean, sig = self.predictive(Z_test, z, q.A['mean'], q.A['cov'], q.tau_mean())
+        return self.sigmoid(mean/(np.sqrt(1+(np.pi/8)*sig)))
     
-    def predict_proba_th(self, Z_test, pruning_crit):
+    def features_th(self, pruning_crit):
+        """Features whose weight is above pruning_crit times the largest."""
         q = self.q_dist
         maximo = np.max(abs(self.z.T @ q.A['mean']))
-        fact = np.arange(self.z.shape[1])[(abs(self.z.T @ q.A['mean']) > maximo*pruning_crit).flatten()].astype(int)
-        z = self.z.copy()
-        z = z[:,fact]
-        Z_test = Z_test[:,fact]
-
-        probs = np.zeros((np.shape(Z_test)[0],1))
-        for i in range(np.shape(Z_test)[0]):
-            mean = Z_test[np.newaxis,i,:] @ z.T @ q.A['mean']
-            sig = q.tau_mean() + Z_test[np.newaxis,i,:] @ z.T @ q.A['cov'] @ z @ Z_test[np.newaxis,i,:].T
-            prob = self.sigmoid(mean/(np.sqrt(1+(np.pi/8)*sig)))
-            probs[i,0] = prob
-        return probs
+        return np.arange(self.z.shape[1])[(abs(self.z.T @ q.A['mean']) > maximo*pruning_crit).flatten()].astype(int)
+    
+    def predict_proba(self, Z_test):
+        return self.batch_proba(Z_test)
+    
+    def predict_proba_th(self, Z_test, pruning_crit):
+        fact = self.features_th(pruning_crit)
+        return self.batch_proba(Z_test[:,fact], self.z[:,fact])
 
     
     def return_a(self):
@@ -185,14 +249,8 @@ class LR_ARD(object):
     def return_pred(self):
         q = self.q_dist
         
-        probs = np.zeros((np.shape(self.z_tst)[0],1))
-        sigs = np.zeros((np.shape(self.z_tst)[0],1))
-        for i in range(np.shape(self.z_tst)[0]):
-            mean = self.z_tst[np.newaxis,i,:] @ self.z.T @ q.A['mean']
-            sig = q.tau_mean() + self.z_tst[np.newaxis,i,:] @ self.z.T @ q.A['cov'] @ self.z @ self.z_tst[np.newaxis,i,:].T
-            prob = self.sigmoid(mean/(np.sqrt(1+(np.pi/8)*sig)))
-            probs[i,0] = prob
-            sigs[i,0] = sig
+        mean, sigs = self.predictive(self.z_tst, self.z, q.A['mean'], q.A['cov'], q.tau_mean())
+        probs = self.sigmoid(mean/(np.sqrt(1+(np.pi/8)*sigs)))
         pred = np.where(probs.ravel()>0.5,1,0)
         return pred, sigs
     
@@ -206,52 +264,20 @@ class LR_ARD(object):
         return self.index
     
     def return_proba(self):
-        q = self.q_dist
-        
-        probs = np.zeros((np.shape(self.z_tst)[0],1))
-        # inv = self.myInverse(q.A['cov']) 
-        for i in range(np.shape(self.z_tst)[0]):
-            mean = self.z_tst[np.newaxis,i,:] @ self.z.T @ q.A['mean']
-            sig = q.tau_mean() + self.z_tst[np.newaxis,i,:] @ self.z.T @ q.A['cov'] @ self.z @ self.z_tst[np.newaxis,i,:].T
-            # sig = 1/q.tau_mean() + self.z_tst[np.newaxis,i,:] @ self.z.T @ q.A['cov'] @ self.z @ self.z_tst[np.newaxis,i,:].T
-            prob = self.sigmoid(mean/(np.sqrt(1+(np.pi/8)*sig)))
-            probs[i,0] = prob
-        return probs
+        return self.batch_proba(self.z_tst)
     
     def return_proba_th(self, pruning_crit):
-        q = self.q_dist
-        maximo = np.max(abs(self.z.T @ q.A['mean']))
-        fact = np.arange(self.z.shape[1])[(abs(self.z.T @ q.A['mean']) > maximo*pruning_crit).flatten()].astype(int)
+        fact = self.features_th(pruning_crit)
         self.z = self.z[:,fact]
         self.z_tst = self.z_tst[:,fact]
-
-        probs = np.zeros((np.shape(self.z_tst)[0],1))
-        for i in range(np.shape(self.z_tst)[0]):
-            mean = self.z_tst[np.newaxis,i,:] @ self.z.T @ q.A['mean']
-            sig = q.tau_mean() + self.z_tst[np.newaxis,i,:] @ self.z.T @ q.A['cov'] @ self.z @ self.z_tst[np.newaxis,i,:].T
-            # sig = 1/q.tau_mean() + self.z_tst[np.newaxis,i,:] @ self.z.T @ q.A['cov'] @ self.z @ self.z_tst[np.newaxis,i,:].T
-            prob = self.sigmoid(mean/(np.sqrt(1+(np.pi/8)*sig)))
-            probs[i,0] = prob
-        return probs
-
-
+        return self.batch_proba(self.z_tst)
     
     def return_proba_train(self):
-        q = self.q_dist
-        
-        probs = np.zeros((np.shape(self.z)[0],1))
-        for i in range(np.shape(self.z)[0]):
-            mean = self.z[np.newaxis,i,:] @ self.z.T @ q.A['mean']
-            sig = q.tau_mean() + self.z[np.newaxis,i,:] @ self.z.T @ q.A['cov'] @ self.z @ self.z[np.newaxis,i,:].T
-            prob = self.sigmoid(mean/(np.sqrt(1+(np.pi/8)*sig)))
-            probs[i,0] = prob
-        return probs
+        return self.batch_proba(self.z)
         
     def sigmoid(self,x):
-        if any(x < 0):
-            return np.exp(x)/(1 + np.exp(x))
-        else:
-            return 1/(1 + np.exp(-x))
+        # Stable for any sign of x, elementwise on arrays
+        return expit(x)
     
     def fit_vb(self, prune, maxit=30, pruning_crit = 1e-1, tol = 1e-6):
         q = self.q_dist
@@ -288,21 +314,26 @@ class LR_ARD(object):
     def myInverse(self,X):
         """Computation of the inverse of a matrix.
         
-        This function calculates the inverse of a matrix in an efficient way 
-        using the Cholesky decomposition.
+        This function calculates the inverse of a symmetric positive definite
+        matrix in an efficient way using the Cholesky decomposition. If the
+        factorization fails, a growing jitter is added to the diagonal; the
+        pseudo-inverse (SVD) is only the last resort.
         
         Parameters
         ----------
-        __A: bool, (default 0). 
-            Whether or not to print all the lower bound updates.
+        __X: array (shape = [N, N]). 
+            Symmetric positive definite matrix.
             
         """
         
-        # try:
-        #     L = linalg.pinv(np.linalg.cholesky(X), rcond=1e-10) #np.linalg.cholesky(A)
-        #     return np.dot(L.T,L) #linalg.pinv(L)*linalg.pinv(L.T)
-        # except:
-        #     return np.nan
+        I = np.eye(X.shape[0])
+        scale = np.mean(np.diag(X))
+        for jitter in [0, 1e-10, 1e-8, 1e-6]:
+            try:
+                c = linalg.cho_factor(X + jitter*scale*I, lower=True)
+                return linalg.cho_solve(c, I)
+            except (linalg.LinAlgError, ValueError):
+                pass
         try:
             return linalg.pinv(X)
         except:
@@ -311,52 +342,75 @@ class LR_ARD(object):
     
     def update_a(self):
         q = self.q_dist
+        if self.primal:
+            self.update_w()
+            return
         
-        a_cov = self.z @ np.diagflat(q.alpha_mean()) @ self.z.T + q.tau_mean() * (self.K_tr.T @ self.K_tr)
+        # KTK is cached, z @ diag(alpha) @ z.T scales the columns of z
+        a_cov = (self.z * q.alpha_mean()) @ self.z.T + q.tau_mean() * self.KTK
         a_cov_inv = self.myInverse(a_cov)
         
         if not np.any(np.isnan(a_cov_inv)):
             q.A['cov'] = a_cov_inv
             ##############
-            q.A['mean'] = q.tau_mean() * q.A['cov'] @ self.K_tr.T @ q.Y['mean']
+            q.A['mean'] = q.tau_mean() * q.A['cov'] @ (self.K_tr.T @ q.Y['mean'])
             #############
             q.A['prodT'] = q.A['mean'] @ q.A['mean'].T + q.A['cov']
         else:
             print('Covariance of A not invertible, not Updated')
+
+    def update_w(self):
+        """update_a in the primal: posterior of the weights w = z.T @ A."""
+        q = self.q_dist
+        
+        w_cov = np.diagflat(q.alpha_mean()) + q.tau_mean() * self.ZTZ
+        w_cov_inv = self.myInverse(w_cov)
+        
+        if not np.any(np.isnan(w_cov_inv)):
+            q.W['cov'] = w_cov_inv
+            q.W['mean'] = q.tau_mean() * q.W['cov'] @ (self.z.T @ q.Y['mean'])
+            q.W['prodT'] = q.W['mean'] @ q.W['mean'].T + q.W['cov']
+        else:
+            print('Covariance of W not invertible, not Updated')
     
     def update_alpha(self):
         q = self.q_dist
 
         q.alpha['a'] = (self.hyper.alpha_a + 0.5)
-        q.alpha['b'] = (self.hyper.alpha_b + 0.5 * np.diag(self.z.T @ q.A['prodT'] @ self.z))
+        if self.primal:
+            q.alpha['b'] = (self.hyper.alpha_b + 0.5 * np.diag(q.W['prodT']))
+            return
+        # diag(z.T @ prodT @ z) as a row-wise contraction over N, the KxK
+        # product is never formed (memory N*K instead of K*K)
+        q.alpha['b'] = (self.hyper.alpha_b + 0.5 * np.einsum('nk,nk->k', q.A['prodT'] @ self.z, self.z))
     
     def update_tau(self):
         q = self.q_dist
         
         q.tau['a'] = self.N*0.5 + self.hyper.tau_a
         
-        q.tau['b'] = 0.5*(np.trace(q.Y['prodT']) - 2*np.trace(q.Y['mean'].T @ self.K_tr @ q.A['mean']) + np.trace(self.K_tr.T @ self.K_tr @ q.A['prodT']))+self.hyper.tau_b
+        # trace(E[y y^T]) from the mean and the variances of Y
+        # trace(KTK @ A['prodT']) from the cached KTK, elementwise since
+        # both are symmetric (trace(ZTZ @ W['prodT']) in the primal)
+        if self.primal:
+            quad = np.sum(self.ZTZ * q.W['prodT'])
+        else:
+            quad = np.sum(self.KTK * q.A['prodT'])
+        q.tau['b'] = 0.5*(np.sum(q.Y['mean']**2 + q.Y['cov']) - 2*np.sum(q.Y['mean'] * (self.z @ self.w_mean())) + quad)+self.hyper.tau_b
     
     def update_y(self):
         q = self.q_dist
-        y_cov = q.tau_mean()*np.eye(self.N) + 2*np.diagflat(q.xi['mean'])
-        y_cov_inv = self.myInverse(y_cov)
+        # The precision tau*I + 2*diag(xi) is diagonal: Y['cov'] keeps only
+        # the variances (Nx1), inverted elementwise
+        q.Y['cov'] = 1/(q.tau_mean() + 2*q.xi['mean'])
         
-        if not np.any(np.isnan(y_cov_inv)):
-            q.Y['cov'] = y_cov_inv
-            
-            
-            #q.Y['mean'] = q.Y['cov'] @ (self.t - 0.5*np.ones((self.N,1)) + q.tau_mean() * self.z @ self.z.T @ q.A['mean'])
+        #q.Y['mean'] = q.Y['cov'] * (self.t - 0.5*np.ones((self.N,1)) + q.tau_mean() * self.z @ self.z.T @ q.A['mean'])
 
-            q.Y['mean'] = q.Y['cov'] @ (self.t - 0.5*np.ones((self.N,1)) + q.tau_mean() * self.K_tr @ q.A['mean'])
-            
-            q.Y['prodT'] = q.Y['mean'] @ q.Y['mean'].T + q.Y['cov']
-        else:
-            print('Covariance of Y not invertible, not Updated')
+        q.Y['mean'] = q.Y['cov'] * (self.t - 0.5*np.ones((self.N,1)) + q.tau_mean() * self.z @ self.w_mean())
     
     def update_xi(self):
         q = self.q_dist
-        q.xi['mean'] = (q.Y['mean'].reshape((self.N,)))**2 + np.diag(q.Y['cov'])
+        q.xi['mean'] = q.Y['mean']**2 + q.Y['cov']
             
     def HGamma(self, a, b):
         """Compute the entropy of a Gamma distribution.
@@ -418,7 +472,12 @@ class LR_ARD(object):
         """
         
         q = self.q_dist
-        q.A['LH'] = self.HGauss(q.A['mean'], q.A['cov'], q.A['LH'])
+        if self.primal:
+            # log pseudo-determinant of the dual covariance of A
+            H = 0.5*self.N*(np.linalg.slogdet(q.W['cov'])[1] - self.ZTZ_logdet)
+            q.A['LH'] = self.checkInfinity(H, q.A['LH'])
+        else:
+            q.A['LH'] = self.HGauss(q.A['mean'], q.A['cov'], q.A['LH'])
 #        q.V['LH'] = self.HGauss(q.V['mean'], np.diagflat(q.V['cov']), q.V['LH'])
         #lel = self.HGauss(q.V['mean'], np.diagflat(q.V['cov']), q.V['LH'])
         #q.b['LH'] = self.HGauss(q.b['mean'], q.b['cov'], q.b['LH'])
@@ -455,6 +514,198 @@ class LR_ARD(object):
         return mean, sigma
         
 
+class MultiLR_ARD(LR_ARD):
+    """Multi-output LR_ARD: one binary output per column of a one-hot target.
+    
+    The outputs share the inputs, so the kernel K_tr = z @ z.T and its Gram
+    products KTK and KTY are computed once. The variational updates of the C
+    outputs run as batched linear algebra over a leading output dimension:
+    A['cov'] and A['prodT'] are (C, N, N); A['mean'], Y['mean'], Y['cov']
+    (variances) and xi['mean'] are (N, C); tau is (C,) and alpha['b'] (C, K).
+    In the primal, W['mean'] is (K, C) and W['cov'], W['prodT'] (C, K, K).
+    Each output gets the same posterior as a binary LR_ARD trained on its
+    column.
+    """
+
+    def fit(self, z, y, z_tst = None, y_tst = None,  hyper = None, prune = 0, maxit = 15, 
+            pruning_crit = 1e-6, tol = 1e-6):
+        self.z = z  #(NxK)
+        self.z_tst = z_tst  #(NxK_tst)
+        self.y_tst = y_tst  #(NxC_tst)
+        self.t_tst = y_tst
+        self.y = y  #(NxC), one-hot
+        self.t = y
+        self.fact_sel = np.arange(self.z.shape[1])
+        
+        self.K = self.z.shape[1] #num dimensiones input
+        self.D = self.t.shape[1] #num salidas
+        self.N = self.z.shape[0] # num datos
+        self.N_tst = self.z_tst.shape[0]
+        self.index = np.arange(self.K)
+        
+        # Kernel products shared by all the outputs
+        self.update_gram()
+        self.L = []
+        self.input_idx = np.ones(self.K, bool)
+        if hyper == None:
+            self.hyper = HyperParameters(self.K, self.N)
+        else:
+            self.hyper = hyper
+        self.q_dist = Qdistribution(self.N, self.D, self.K, self.hyper)
+        self.init_outputs()
+
+        self.fit_vb(prune, maxit, pruning_crit, tol)
+        self.dual_posterior()
+
+    def init_outputs(self):
+        """Stack the initial posterior of Qdistribution once per output."""
+        q = self.q_dist
+        C, N = self.D, self.N
+        q.alpha['b'] = np.tile(self.hyper.alpha_b, (C, 1))
+        q.tau['a'] = np.full(C, self.hyper.tau_a, float)
+        q.tau['b'] = np.full(C, self.hyper.tau_b, float)
+        q.A['mean'] = np.random.normal(0.0, 1.0, (N, C))
+        q.A['cov'] = np.tile(np.eye(N), (C, 1, 1))
+        q.A['prodT'] = q.A['cov'].copy()
+        q.A['LH'] = np.zeros(C)
+        q.Y['mean'] = (1/2)*np.ones((N, C))
+        q.Y['cov'] = np.ones((N, C))
+        q.xi['mean'] = np.ones((N, C))
+
+    def pruning(self, pruning_crit):
+        """Keep the features relevant to any of the outputs."""
+        q = self.q_dist
+        
+        w = abs(self.w_mean())
+        self.fact_sel = np.arange(self.z.shape[1])[(w > np.max(w, axis=0)*pruning_crit).any(axis=1)].astype(int)
+        
+        aux = self.input_idx[self.input_idx]
+        aux[self.fact_sel] = False
+        self.input_idx[self.input_idx] = ~aux
+        
+        was_primal = self.primal
+        self.z = self.z[:,self.fact_sel]
+        self.z_tst = self.z_tst[:,self.fact_sel]
+        self.update_gram()
+        if self.primal:
+            if was_primal:
+                q.W['mean'] = q.W['mean'][self.fact_sel]
+                q.W['cov'] = q.W['cov'][:, self.fact_sel][:, :, self.fact_sel]
+            else:
+                q.W['mean'] = self.z.T @ q.A['mean']
+                q.W['cov'] = self.z.T @ q.A['cov'] @ self.z
+            q.W['prodT'] = np.einsum('kc,lc->ckl', q.W['mean'], q.W['mean']) + q.W['cov']
+        q.alpha['a'] = q.alpha['a'][..., self.fact_sel]
+        q.alpha['b'] = q.alpha['b'][:, self.fact_sel]
+        self.hyper.alpha_a = self.hyper.alpha_a[self.fact_sel]
+        self.hyper.alpha_b = self.hyper.alpha_b[self.fact_sel]
+        self.index = self.index[self.fact_sel]
+
+    def predict_proba_th(self, Z_test, pruning_crit):
+        """Probabilities of every output (shape = [n_samples, C]), each one
+        computed on the features selected by its own weights."""
+        q = self.q_dist
+        w = abs(self.z.T @ q.A['mean'])
+        probs = np.zeros((np.shape(Z_test)[0], self.D))
+        for c in range(self.D):
+            fact = w[:, c] > np.max(w[:, c])*pruning_crit
+            mean, sig = self.predictive(Z_test[:, fact], self.z[:, fact], q.A['mean'][:, [c]], q.A['cov'][c], q.tau_mean()[c])
+            probs[:, [c]] = self.sigmoid(mean/(np.sqrt(1+(np.pi/8)*sig)))
+        return probs
+
+    def myInverse(self,X):
+        """Inverse of a stack of matrices, each one as LR_ARD.myInverse."""
+        inverses = [LR_ARD.myInverse(self, x) for x in X]
+        if any(np.isscalar(inv) for inv in inverses):
+            return np.nan
+        return np.stack(inverses)
+
+    def dual_posterior(self):
+        q = self.q_dist
+        if not self.primal:
+            return
+        P = self.z @ self.myInverse(self.ZTZ[np.newaxis])[0]
+        q.A['mean'] = P @ q.W['mean']
+        q.A['cov'] = P @ q.W['cov'] @ P.T
+        q.A['prodT'] = np.einsum('nc,mc->cnm', q.A['mean'], q.A['mean']) + q.A['cov']
+
+    def update_a(self):
+        q = self.q_dist
+        tau = q.tau_mean()
+        if self.primal:
+            self.update_w()
+            return
+        
+        a_cov = (self.z * q.alpha_mean()[:, np.newaxis, :]) @ self.z.T + tau[:, np.newaxis, np.newaxis] * self.KTK
+        a_cov_inv = self.myInverse(a_cov)
+        
+        if not np.any(np.isnan(a_cov_inv)):
+            q.A['cov'] = a_cov_inv
+            q.A['mean'] = tau * np.einsum('cnm,mc->nc', q.A['cov'], self.K_tr.T @ q.Y['mean'])
+            q.A['prodT'] = np.einsum('nc,mc->cnm', q.A['mean'], q.A['mean']) + q.A['cov']
+        else:
+            print('Covariance of A not invertible, not Updated')
+
+    def update_w(self):
+        q = self.q_dist
+        tau = q.tau_mean()
+        
+        w_cov = np.einsum('ck,kl->ckl', q.alpha_mean(), np.eye(self.z.shape[1])) + tau[:, np.newaxis, np.newaxis] * self.ZTZ
+        w_cov_inv = self.myInverse(w_cov)
+        
+        if not np.any(np.isnan(w_cov_inv)):
+            q.W['cov'] = w_cov_inv
+            q.W['mean'] = tau * np.einsum('ckl,lc->kc', q.W['cov'], self.z.T @ q.Y['mean'])
+            q.W['prodT'] = np.einsum('kc,lc->ckl', q.W['mean'], q.W['mean']) + q.W['cov']
+        else:
+            print('Covariance of W not invertible, not Updated')
+    
+    def update_alpha(self):
+        q = self.q_dist
+
+        q.alpha['a'] = (self.hyper.alpha_a + 0.5)
+        if self.primal:
+            q.alpha['b'] = (self.hyper.alpha_b + 0.5 * np.diagonal(q.W['prodT'], axis1=1, axis2=2))
+            return
+        # Per-feature quadratic forms of every output, as in LR_ARD
+        q.alpha['b'] = (self.hyper.alpha_b + 0.5 * np.einsum('cnk,nk->ck', q.A['prodT'] @ self.z, self.z))
+    
+    def update_tau(self):
+        q = self.q_dist
+        
+        q.tau['a'] = np.full(self.D, self.N*0.5 + self.hyper.tau_a)
+        
+        if self.primal:
+            quad = np.einsum('kl,clk->c', self.ZTZ, q.W['prodT'])
+        else:
+            quad = np.einsum('nm,cmn->c', self.KTK, q.A['prodT'])
+        q.tau['b'] = 0.5*(np.sum(q.Y['mean']**2 + q.Y['cov'], axis=0) - 2*np.sum(q.Y['mean'] * (self.z @ self.w_mean()), axis=0) + quad)+self.hyper.tau_b
+    
+    def update_y(self):
+        q = self.q_dist
+        q.Y['cov'] = 1/(q.tau_mean() + 2*q.xi['mean'])
+        q.Y['mean'] = q.Y['cov'] * (self.t - 0.5 + q.tau_mean() * (self.z @ self.w_mean()))
+    
+    def update_xi(self):
+        q = self.q_dist
+        q.xi['mean'] = q.Y['mean']**2 + q.Y['cov']
+
+    def update_bound(self):
+        """Lower bound, summed over the outputs."""
+        q = self.q_dist
+        if self.primal:
+            H = 0.5*self.N*(np.linalg.slogdet(q.W['cov'])[1] - self.ZTZ_logdet)
+        else:
+            H = 0.5*self.N*np.linalg.slogdet(q.A['cov'])[1]
+        q.A['LH'] = np.where(abs(H) == np.inf, q.A['LH'], H)
+        
+        q.tau['ElogpWalp'] = -(0.5 *  self.N + self.hyper.tau_a - 2)* np.log(q.tau['b'])
+        q.alpha['Elogp'] = -(0.5 + np.mean(self.hyper.alpha_a) - 2)* np.sum(np.log(q.alpha['b']), axis=1)
+        
+        ElogP = q.tau['ElogpWalp'] + q.alpha['Elogp'] 
+        return np.sum(ElogP - q.A['LH'])
+
+
 class HyperParameters(object):
     def __init__(self, K, N):
         #self.alpha_a = 2 * np.ones((K,))
@@ -514,6 +765,13 @@ class Qdistribution(object):
                 "LH":       0,
                 "Elogp":    0,
             }
+        
+        # Posterior of the weights w = z.T @ A, only used in the primal
+        self.W = {
+                "mean":     None,
+                "cov":      None,
+                "prodT":    None,
+            }
             
 #        self.W["mean"] = np.random.normal(0.0, 1.0, self.D * self.K).reshape(self.D, self.K)
 #        self.W["cov"] = np.eye(self.K)
@@ -531,8 +789,8 @@ class Qdistribution(object):
         
         #Inicializamos las Y
         self.Y["mean"] = (1/2)*np.ones((self.n,1))
-        self.Y["cov"] = np.eye(self.n)
-        self.Y["prodT"] = self.Y["mean"].T @ self.Y["mean"]+self.n*self.Y["cov"]
+        # Diagonal posterior, only the variances are kept
+        self.Y["cov"] = np.ones((self.n,1))
         
         #Inicializamos Xi
         self.xi["mean"] = np.ones((self.n,1))
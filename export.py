@@ -0,0 +1,167 @@
+import json
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from spectrum_store import SpectrumView, materialize
+
+# Columnar export of datasets and prediction results. Spectra go to Parquet
+# as a fixed-size list column (one list of n_features values per sample) and
+# are written one row group at a time, so an export never holds more than
+# row_group_rows spectra in memory.
+
+ROW_GROUP_ROWS = 1024
+
+
+def column_type(values):
+    """Arrow type of a metadata column, decided once on the whole column.
+
+    Numeric and boolean columns keep their type. Object columns are bool,
+    int64 or float64 if all their non-missing values are, and string
+    otherwise (e.g. labels mixing ints, strings and NaN); an empty column is
+    string.
+    """
+    if values.dtype != object:
+        return pa.from_numpy_dtype(values.dtype)
+    present = [value for value in values if not pd.isna(value)]
+    if len(present) > 0 and all(
+        isinstance(value, (bool, np.bool_)) for value in present
+    ):
+        return pa.bool_()
+    if len(present) > 0 and all(
+        isinstance(value, (int, np.integer))
+        and not isinstance(value, (bool, np.bool_))
+        for value in present
+    ):
+        return pa.int64()
+    if len(present) > 0 and all(
+        isinstance(value, (int, float, np.integer, np.floating))
+        and not isinstance(value, (bool, np.bool_))
+        for value in present
+    ):
+        return pa.float64()
+    return pa.string()
+
+
+def metadata_table(metadata):
+    """Explicit schema of the metadata columns, and the metadata converted to
+    it (missing values as None), so every row group gets the same schema."""
+    metadata = metadata.reset_index(drop=True)
+    fields, columns = [], {}
+    for name in metadata.columns:
+        values = metadata[name]
+        if isinstance(values.dtype, np.dtype):
+            arrow_type = column_type(values)
+        elif pd.api.types.is_string_dtype(values.dtype):
+            arrow_type = pa.string()
+        else:
+            # pandas extension dtypes (string, nullable ints...) know their type
+            arrow_type = pa.Array.from_pandas(values).type
+        if arrow_type == pa.string():
+            values = values.astype(object).map(
+                lambda value: None if pd.isna(value) else str(value)
+            )
+        elif values.dtype == object:
+            values = values.map(lambda value: None if pd.isna(value) else value)
+        fields.append(pa.field(str(name), arrow_type))
+        columns[str(name)] = values
+    return pa.schema(fields), pd.DataFrame(columns)
+
+
+def spectra_schema(metadata, n_features, dtype, mz=None, scale=1.0):
+    """Schema of a spectra export: metadata columns plus "intensity".
+
+    The type of every metadata column is declared (see metadata_table). The
+    m/z grid and the store scale are kept in the schema metadata.
+    """
+    schema, metadata = metadata_table(metadata)
+    schema = schema.append(
+        pa.field("intensity", pa.list_(pa.from_numpy_dtype(dtype), n_features))
+    )
+    info = dict(schema.metadata or {})
+    info[b"scale"] = json.dumps(scale).encode()
+    if mz is not None:
+        info[b"mz"] = json.dumps(np.asarray(mz).tolist()).encode()
+    return schema.with_metadata(info)
+
+
+def export_spectra(data, path, row_group_rows=ROW_GROUP_ROWS, csv_summary=None):
+    """Write a SpectrumStore or SpectrumView to a Parquet file.
+
+    Intensities are written as stored (unscaled, in the store dtype); the
+    scale to apply is saved with the file, see read_spectra.
+
+    Parameters
+    ----------
+    __data: SpectrumStore or SpectrumView.
+        Dataset to export.
+    __path: str.
+        Destination .parquet file.
+    __row_group_rows: int, (default ROW_GROUP_ROWS).
+        Number of spectra per row group (and in memory at a time).
+    __csv_summary: str, (default None).
+        If given, the metadata columns (no spectra) are also written to this
+        CSV, to be opened in a spreadsheet.
+    """
+    if isinstance(data, SpectrumView):
+        store, rows = data.store, data.rows
+    else:
+        store, rows = data, np.arange(len(data))
+    metadata_schema, metadata = metadata_table(data.metadata)
+    schema = spectra_schema(
+        metadata,
+        store.intensities.shape[1],
+        store.intensities.dtype,
+        mz=store.mz,
+        scale=store.scale,
+    )
+
+    with pq.ParquetWriter(path, schema) as writer:
+        for start in range(0, len(rows), row_group_rows):
+            stop = start + row_group_rows
+            x = materialize(store.intensities, rows[start:stop])
+            columns = pa.Table.from_pandas(
+                metadata.iloc[start:stop], schema=metadata_schema, preserve_index=False
+            ).columns
+            intensity = pa.FixedSizeListArray.from_arrays(x.ravel(), x.shape[1])
+            writer.write_table(pa.Table.from_arrays(columns + [intensity], schema=schema))
+
+    if csv_summary is not None:
+        data.metadata.to_csv(csv_summary, index=False)
+
+
+def read_spectra(path, scaled=True):
+    """Read a file written by export_spectra.
+
+    Returns
+    -------
+    __metadata: DataFrame.
+        One row per sample.
+    __intensities: array (shape = [n_samples, n_features]).
+        Spectra, with the stored scale applied if scaled.
+    __mz: array (shape = [n_features,]) or None.
+        m/z grid of the spectra.
+    """
+    table = pq.read_table(path)
+    info = table.schema.metadata
+    intensity = table.column("intensity").combine_chunks()
+    n_features = intensity.type.list_size
+    intensities = intensity.flatten().to_numpy().reshape(-1, n_features)
+    if scaled:
+        intensities = intensities * json.loads(info[b"scale"])
+    mz = np.asarray(json.loads(info[b"mz"])) if b"mz" in info else None
+    metadata = table.drop_columns(["intensity"]).to_pandas()
+    return metadata, intensities, mz
+
+
+def export_table(df, path, row_group_rows=ROW_GROUP_ROWS, csv_summary=None):
+    """Write a results DataFrame to Parquet, and optionally to a CSV for
+    clinicians (e.g. the per-sample predictions of predict.py)."""
+    schema, table = metadata_table(df)
+    pq.write_table(
+        pa.Table.from_pandas(table, schema=schema, preserve_index=False),
+        path,
+        row_group_size=row_group_rows,
+    )
+    if csv_summary is not None:
+        df.to_csv(csv_summary, index=False)
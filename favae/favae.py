@@ -1,6 +1,7 @@
 
 import numpy as np
 from scipy import linalg
+from scipy.sparse import issparse
 import copy
 from scipy.stats import norm
 from sklearn.preprocessing import label_binarize
@@ -169,7 +170,7 @@ class SSHIBA(object):
         for arg in args:
             m += 1
             if arg["kernel"] != "pike":
-                if not (None in arg["data"]):
+                if issparse(arg["data"]) or not (None in arg["data"]):
                     self.n.append(int(arg["data"].shape[0]))
                     if arg["method"] == "reg":  # Regression
                         self.d.append(int(arg["data"].shape[1]))
@@ -225,20 +226,22 @@ class SSHIBA(object):
                 if self.k[m] == "linear":
                     if self.sparse_fs[m]:
                         self.sparse_K[m] = SparseELBO(
-                            self.X[m]["X"],
-                            self.V[m],
+                            self.dense(self.X[m]["X"]),
+                            self.dense(self.V[m]),
                             self.sparse_fs[m],
                             kernel=self.k[m],
                         )
                         data = self.sparse_K[m].get_params()[0]
                         self.it_fs = 1
                     else:
-                        data = np.dot(self.X[m]["X"], self.V[m].T)
+                        data = self.linear_kernel(self.X[m]["X"], self.V[m])
                 # RBF Kernel
                 elif self.k[m] == "rbf":
                     if self.sig[m] == "auto" or self.sparse_fs[m]:
                         self.sparse_K[m] = SparseELBO(
-                            self.X[m]["X"], self.V[m], self.sparse_fs[m]
+                            self.dense(self.X[m]["X"]),
+                            self.dense(self.V[m]),
+                            self.sparse_fs[m],
                         )
                         data = self.sparse_K[m].get_params()[0]
                         self.it_fs = 1
@@ -696,11 +699,11 @@ class SSHIBA(object):
         if X1.ndim == 1:
             X1 = X1[:, np.newaxis]
             X2 = X2[:, np.newaxis]
-        G = (X1 * X1).sum(axis=1)
-        H = (X2 * X2).sum(axis=1)
+        G = self.squared_norms(X1)
+        H = self.squared_norms(X2)
         Q = np.tile(G, [size2, 1]).T
         R = np.tile(H, [size1, 1])
-        KK = np.dot(X1, X2.T)
+        KK = self.linear_kernel(X1, X2)
         dist = Q + R - 2 * KK
         if sig == 0:  # Then, we calculate its value
             aux = (dist - np.tril(dist)).reshape(size1 * size2, 1)
@@ -708,6 +711,30 @@ class SSHIBA(object):
         K = np.exp(-dist / sig**2)
         return K, sig
 
+    def linear_kernel(self, X1, X2):
+        """Linear kernel X1 @ X2.T as a dense array.
+
+        X1 and X2 may be scipy.sparse matrices (e.g. peak lists in CSR), then
+        the cost is proportional to the number of stored peaks instead of the
+        number of features.
+        """
+        K = X1 @ X2.T
+        if issparse(K):
+            K = K.toarray()
+        return np.asarray(K)
+
+    def squared_norms(self, X):
+        """Squared euclidean norm of every row of a dense or sparse matrix."""
+        if issparse(X):
+            return np.asarray(X.multiply(X).sum(axis=1)).ravel()
+        return (X * X).sum(axis=1)
+
+    def dense(self, X):
+        """Dense copy of a sparse view, for the code paths that need arrays."""
+        if issparse(X):
+            return X.toarray()
+        return X
+
     def center_K(self, K):
         """Center a kernel matrix K, i.e., removes the data mean in the feature space
         Args:
@@ -887,6 +914,10 @@ class SSHIBA(object):
             Indicates if the variable wants to have sparsity in its features
             or not.
 
+        X (and V) can also be scipy.sparse matrices, e.g. the CSR peak matrix
+        of maldi_preprocess.peak_matrix. With a kernel they are kept sparse
+        and the kernel is computed from the stored peaks only; without one
+        the view is used as is, so it is converted to a dense array.
         """
         if not (V is None):
             if kernel is None:
@@ -894,6 +925,11 @@ class SSHIBA(object):
             else:
                 kernel = kernel.lower()
 
+        if issparse(X):
+            X = X.tocsr() if V is not None else X.toarray()
+        if issparse(V):
+            V = V.tocsr()
+
         X = dict(
             data=X,
             sparse=sparse,
@@ -1835,11 +1871,13 @@ class SSHIBA(object):
                     if k == "linear":
                         # var = np.sqrt(self.sparse_K[0].get_params()[1])
                         var = 1
-                        arg["data"] = np.dot(var * X, (var * V).T)
+                        arg["data"] = self.linear_kernel(var * X, var * V)
                     # RBF Kernel
                     elif k == "rbf":
                         if sig == "auto":
-                            self.sparse_K[m] = SparseELBO(X, V, self.sparse_fs[m])
+                            self.sparse_K[m] = SparseELBO(
+                                self.dense(X), self.dense(V), self.sparse_fs[m]
+                            )
                             arg["data"], _ = self.sparse_K[m].get_params()[0]
                         else:
                             arg["data"], sig = self.rbf_kernel_sig(X, V, sig=sig)
@@ -12,6 +12,7 @@ from torch import nn
 import numpy as np
 from torch.utils.data import TensorDataset, DataLoader
 from tqdm import tqdm
+from spectrum_store import BatchIterator
 
 
 class VAE(nn.Module):
@@ -143,7 +144,12 @@ class SignalVAE(VAE):
         favae=False,
     ):
         if img is not None:
-            self.img = torch.Tensor(np.expand_dims(img, axis=1))
+            # Spectra (array, SpectrumStore or SpectrumView) are streamed in
+            # float32 batches, only the shape is kept for the decoders
+            self.batches = BatchIterator(
+                img, batch_size=8, shuffle=True, return_index=True
+            )
+            self.img_shape = (self.batches.shape[0], 1, self.batches.shape[1])
         # Lists to store training evolution
         self.loss_during_training = []
         self.elbo_training = []
@@ -162,12 +168,10 @@ class SignalVAE(VAE):
             tau = torch.Tensor(np.asarray(tau)).to(self.device)
         else:
             # Without FA-VAE we suppose a N(0,1) as prior
-            prior_mean = torch.zeros((img.shape[0], self.dimx))
+            prior_mean = torch.zeros((self.img_shape[0], self.dimx))
             tau = torch.tensor(1).to(self.device)
 
-        # Create the Dataloader to perform batch learning
-        dataset = TensorDataset(self.img, prior_mean)
-        loader = DataLoader(dataset=dataset, batch_size=8, shuffle=True)
+        loader = self.batches
 
         elbo_checker = -1e20
         self.train()
@@ -177,12 +181,12 @@ class SignalVAE(VAE):
             train_elbo = 0
             train_kl_l = 0
             with tqdm(loader, unit="batch") as tepoch:
-                for images, prior_mu in tepoch:
+                for idx, images in tepoch:
                     tepoch.set_description(f"Epoch {e}")
                     # Move data to GPU
-                    images = images.to(self.device)
+                    images = torch.from_numpy(images).unsqueeze(1).to(self.device)
                     # Moments of the prior
-                    mu_P = prior_mu.to(self.device)
+                    mu_P = prior_mean[torch.from_numpy(idx)].to(self.device)
                     var_P = torch.ones_like(mu_P) * (1 / tau)
                     std_P = torch.sqrt(var_P)
                     # ==================== Gradient calculation ===================
@@ -275,18 +279,15 @@ class SignalVAE(VAE):
         return elbo_checker
 
     def update_x(self, img=None):
-        if img is not None:
-            img = torch.Tensor(img).unsqueeze(1)
-        # Create a loader to update X by batches due to lack of memory
-        dataset = TensorDataset(img)
-        loader = DataLoader(dataset=dataset, batch_size=64, shuffle=False)
-        mu = np.zeros((img.shape[0], self.latentdim))
-        var = np.zeros((img.shape[0], self.latentdim))
+        # Update X by batches read from img due to lack of memory
+        loader = BatchIterator(img, batch_size=64)
+        mu = np.zeros((loader.shape[0], self.latentdim))
+        var = np.zeros((loader.shape[0], self.latentdim))
         self.eval()
         with torch.no_grad():
             batch_index = 0
             for batch_image in loader:
-                batch_image = batch_image[0].to(self.device)
+                batch_image = torch.from_numpy(batch_image).unsqueeze(1).to(self.device)
                 mu_Qbatch, std_Qbatch = self.encoder(batch_image)
                 mu[
                     batch_index : batch_index + batch_image.shape[0]
@@ -295,7 +296,7 @@ class SignalVAE(VAE):
                     std_Qbatch.pow(2).data.cpu().numpy()
                 )
                 batch_index += batch_image.shape[0]
-        del img, dataset, loader, batch_image, mu_Qbatch, std_Qbatch
+        del img, loader, batch_image, mu_Qbatch, std_Qbatch
         torch.cuda.empty_cache()
         return mu, var
 
@@ -304,7 +305,7 @@ class SignalVAE(VAE):
         sample = torch.Tensor(mean + np.random.randn() * np.sqrt(var))
         dataset = TensorDataset(sample)
         loader = DataLoader(dataset=dataset, batch_size=64, shuffle=False)
-        img_rec = np.zeros((mean.shape[0], self.img.shape[1], self.img.shape[2]))
+        img_rec = np.zeros((mean.shape[0], self.img_shape[1], self.img_shape[2]))
         self.eval()
         with torch.no_grad():
             batch_index = 0
@@ -345,7 +346,7 @@ class SignalVAE(VAE):
         loader = DataLoader(dataset=dataset, batch_size=64, shuffle=False)
 
         img_aprox = np.zeros(
-            (mean.shape[0], self.img.shape[1], self.img.shape[2], self.img.shape[3])
+            (mean.shape[0], self.img_shape[1], self.img_shape[2], self.img_shape[3])
         )
         self.eval()
         with torch.no_grad():
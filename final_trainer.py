@@ -2,6 +2,14 @@ import argparse
 import yaml
 import pickle
 import numpy as np
+from spectrum_store import load_store
+from search import load_search, save_search
+from maldi_preprocess import (
+    replicate_groups,
+    aggregate_replicates,
+    peak_matrix,
+    check_grid,
+)
 from performance_tools import plot_importances
 import os
 
@@ -15,25 +23,53 @@ def main(model, config, depth=None, wandbflag=False):
         config = yaml.load(file, Loader=yaml.FullLoader)
 
     main_path = config["main_path"]
-    maldi_path = main_path + "data/data_final.pkl"
+    # Hyperparameter search settings of the RF/DT/LR wrappers
+    search = config.get("search") or {}
+    maldi_path = main_path + "data/final"
     results = main_path + "results_paper/"
 
     # ============ Load data ===================
     print("Loading data...")
-    with open(maldi_path, "rb") as handle:
-        data = pickle.load(handle)
-
-    x = data["intensities"] * 1e4
+    data = load_store(maldi_path)
+    # The models must be fit on the binned grid predict.py feeds them
+    check_grid(data.mz, name=maldi_path)
+
+    replicates = config.get("replicates", {}).get("final")
+    peaks = config.get("peaks")
+    if model == "sgd" and peaks is None and replicates is None:
+        # The incremental model streams the spectra from the store
+        x = data
+    elif peaks is not None and replicates is None:
+        # Peaks are screened straight from the store, no dense copy is made
+        x = data.read_peaks(**peaks)
+    else:
+        x = data.read()
     print(x)
-    masses = data["masses"]
-    y = data["labels"]
+    masses = data.mz
+    y = data.labels
+
+    # Optionally reduce the replicates of each isolate to one spectrum
+    if replicates is not None:
+        _, first, groups = replicate_groups(data.ids)
+        x = aggregate_replicates(x, groups, method=replicates)
+        y = y[first]
+        if peaks is not None:
+            x = peak_matrix(x, **peaks)
 
     # ============ Preprocess data ===================
 
     # Check if path "results_paper/model" exists, if not, create it
     if not os.path.exists(results + "final_model/" + model + "/"):
         os.makedirs(results + "final_model/" + model + "/")
+    # Winner of the exp1 search of the same model (see main_trainer), reused
+    # by the RF/DT/LR wrappers instead of searching again
+    previous = main_path + "results_paper/exp1/" + model + "/search.json"
+    best_params = None
+    if os.path.exists(previous):
+        best_params = load_search(previous)["best_params"]
     results = results + "final_model/" + model
+    # Grid of the features, checked by predict.py before predicting
+    np.save(results + "/mz.npy", masses)
 
     if model == "base":
         return NotImplementedError
@@ -50,9 +86,11 @@ def main(model, config, depth=None, wandbflag=False):
         from models import RF
 
         # Declare the model
-        model = RF(max_depth=depth)
+        model = RF(max_depth=depth, **search)
         # Train it
-        model.fit(x, y)
+        model.fit(x, y, best_params=best_params)
+        if model.search_results is not None:
+            save_search(model.search_results, results + "/search.json")
         model = model.get_model()
 
         # save the model to disk
@@ -71,8 +109,10 @@ def main(model, config, depth=None, wandbflag=False):
     elif model == "lr":
         from models import LR
 
-        model = LR()
-        model.fit(x, y)
+        model = LR(**search)
+        model.fit(x, y, best_params=best_params)
+        if model.search_results is not None:
+            save_search(model.search_results, results + "/search.json")
         model = model.get_model()
 
         # save the model to disk
@@ -99,8 +139,10 @@ def main(model, config, depth=None, wandbflag=False):
     elif model == "dt":
         from models import DecisionTree
 
-        model = DecisionTree(max_depth=depth)
-        model.fit(x, y)
+        model = DecisionTree(max_depth=depth, **search)
+        model.fit(x, y, best_params=best_params)
+        if model.search_results is not None:
+            save_search(model.search_results, results + "/search.json")
         model = model.get_model()
 
         # save the model to disk
@@ -116,6 +158,16 @@ def main(model, config, depth=None, wandbflag=False):
             wandbflag=wandbflag,
         )
 
+    elif model == "sgd":
+        from models import SGD
+
+        model = SGD()
+        model.fit(x, y)
+        model = model.get_model()
+
+        # save the model to disk
+        pickle.dump(model, open(results + "/model_all.pkl", "wb"))
+
     elif model == "favae":
         raise ValueError("Model not implemented")
     else:
@@ -129,7 +181,7 @@ if __name__ == "__main__":
         type=str,
         default="base",
         help="Model to train",
-        choices=["base", "rf", "dt", "favae", "lr"],
+        choices=["base", "rf", "dt", "favae", "lr", "sgd"],
     )
     argparse.add_argument(
         "--config", type=str, default="config.yaml", help="Path to config file"
@@ -0,0 +1,281 @@
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from maldi_preprocess import bin_spectra
+from outlier_screen import OutlierScreen, load_screen
+from spectrum_store import (
+    write_store,
+    load_store,
+    append_rows,
+    replace_rows,
+    delete_rows,
+    DEFAULT_DTYPE,
+)
+
+# Parallel, fault-tolerant parsing of spectrum files. Files are sent to a
+# process pool in chunks, results come back in the input order and a file that
+# cannot be parsed is reported and skipped instead of aborting the run.
+
+
+def read_spectrum_csv(path):
+    """Read a "mass,intensity" CSV as exported by preprocess_maldi.R."""
+    values = pd.read_csv(path).to_numpy(dtype=np.float64)
+    return values[:, 0], values[:, 1]
+
+
+def read_chunk(reader, files):
+    out = []
+    for file in files:
+        try:
+            out.append((reader(file), None))
+        except Exception as err:
+            out.append((None, repr(err)))
+    return out
+
+
+def ingest(files, reader=read_spectrum_csv, n_jobs=None, chunksize=32, verbose=1):
+    """Parse many files with a pool of worker processes.
+
+    Parameters
+    ----------
+    __files: list of str.
+        Paths to parse.
+    __reader: function, (default read_spectrum_csv).
+        Top-level (picklable) function taking one path.
+    __n_jobs: int, (default None).
+        Number of worker processes, all cores if None. 1 parses serially.
+    __chunksize: int, (default 32).
+        Number of files sent to a worker per task.
+    __verbose: int, (default 1).
+        Print progress after every chunk.
+
+    Returns
+    -------
+    __results: list.
+        reader(file) for each file, in the same order as files. None for the
+        files that failed.
+    __failed: list of str.
+        Paths that could not be parsed.
+    """
+    files = list(files)
+    chunks = [files[i : i + chunksize] for i in range(0, len(files), chunksize)]
+    results = [None] * len(files)
+    failed = []
+    done = 0
+
+    def collect(c, chunk_results):
+        for k, (result, error) in enumerate(chunk_results):
+            i = c * chunksize + k
+            results[i] = result
+            if error is not None:
+                print("Error: could not read " + files[i] + ": " + error)
+                failed.append(i)
+
+    if n_jobs == 1 or len(chunks) <= 1:
+        for c, chunk in enumerate(chunks):
+            collect(c, read_chunk(reader, chunk))
+            done += len(chunk)
+            if verbose:
+                print("Loading bar: ", done, "/", len(files))
+    else:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            futures = {
+                pool.submit(read_chunk, reader, chunk): c
+                for c, chunk in enumerate(chunks)
+            }
+            for future in as_completed(futures):
+                c = futures[future]
+                try:
+                    chunk_results = future.result()
+                except Exception as err:
+                    # The worker itself died, the whole chunk is lost
+                    chunk_results = [(None, repr(err))] * len(chunks[c])
+                collect(c, chunk_results)
+                done += len(chunks[c])
+                if verbose:
+                    print("Loading bar: ", done, "/", len(files))
+
+    return results, [files[i] for i in sorted(failed)]
+
+
+# Incremental ingestion: a manifest next to the store records where every row
+# comes from, so a re-run only parses the files that are new or changed.
+MANIFEST_COLUMNS = ["path", "size", "mtime", "sha1"]
+
+
+def file_hash(path):
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as handle:
+        for block in iter(lambda: handle.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def load_manifest(store_path):
+    path = os.path.join(store_path, "manifest.pkl")
+    if os.path.exists(path):
+        return pd.read_pickle(path)
+    return pd.DataFrame(columns=MANIFEST_COLUMNS)
+
+
+def ingest_incremental(
+    store_path,
+    files,
+    describe,
+    reader=read_spectrum_csv,
+    n_jobs=None,
+    chunksize=32,
+    dtype=DEFAULT_DTYPE,
+    scale=1.0,
+    screen_outliers=False,
+    **bin_kwargs
+):
+    """Bring a binned SpectrumStore up to date with a list of source files.
+
+    The manifest (``manifest.pkl``, row i describes row i of the store) keeps
+    path, size, mtime and sha1 of each source file. Files whose size or mtime
+    moved are hashed; only files that are new or whose content changed are
+    parsed. New files are appended, changed ones overwritten in place and rows
+    of files no longer listed are dropped.
+
+    Parameters
+    ----------
+    __store_path: str.
+        Folder of the store, created on the first run.
+    __files: list of str.
+        Current source files of the dataset.
+    __describe: function.
+        Maps a file path to its metadata dict (id, label, experiment...).
+    __reader: function, (default read_spectrum_csv).
+        Parser returning (mass, intensity) for one file.
+    __dtype, __scale:
+        Used when the store is created, see write_store.
+    __screen_outliers: bool, (default False).
+        Score every new spectrum with the OutlierScreen kept in the store
+        folder (``outlier_screen.pkl``), record the result in an "outlier"
+        metadata column and report the flagged files.
+    __bin_kwargs:
+        Grid passed to bin_spectra (mz_min, mz_max, bin_width, method).
+
+    Returns the updated SpectrumStore. Files that cannot be hashed or parsed
+    are reported and skipped; they are retried on the next run.
+    """
+    files = list(files)
+    manifest = load_manifest(store_path)
+    known = dict(zip(manifest["path"], range(len(manifest))))
+
+    stats = {}
+    for file in files:
+        stat = os.stat(file)
+        stats[file] = (stat.st_size, stat.st_mtime)
+
+    # Only hash files whose size or mtime moved since the last run
+    candidates = [
+        file
+        for file in files
+        if file not in known
+        or (manifest["size"][known[file]], manifest["mtime"][known[file]])
+        != stats[file]
+    ]
+    hashes, failed_hash = ingest(
+        candidates, reader=file_hash, n_jobs=n_jobs, chunksize=chunksize, verbose=0
+    )
+
+    new, changed = [], []
+    for file, digest in zip(candidates, hashes):
+        if digest is None:
+            continue
+        if file not in known:
+            new.append((file, digest))
+        elif digest != manifest["sha1"][known[file]]:
+            changed.append((file, digest))
+        else:
+            # Touched but same content, only refresh the stats
+            manifest.loc[known[file], ["size", "mtime"]] = stats[file]
+    listed = set(files)
+    removed = [known[path] for path in manifest["path"] if path not in listed]
+    print(
+        "New files: ",
+        len(new),
+        " changed: ",
+        len(changed),
+        " removed: ",
+        len(removed),
+    )
+
+    # Parse only the delta
+    to_parse = new + changed
+    spectra, failed_parse = ingest(
+        [file for file, digest in to_parse],
+        reader=reader,
+        n_jobs=n_jobs,
+        chunksize=chunksize,
+    )
+    # Unreadable files are left out of the manifest (new ones) or keep their
+    # previous row (changed ones), so the next run tries them again
+    failed = failed_hash + failed_parse
+    if len(failed) > 0:
+        print("Warning:", len(failed), "files could not be read and were skipped:")
+        for file in failed:
+            print("    " + file + (" (new)" if file not in known else ""))
+    parsed = [
+        (file, digest, spectrum)
+        for (file, digest), spectrum in zip(to_parse, spectra)
+        if spectrum is not None
+    ]
+    if len(parsed) > 0:
+        mz, binned = bin_spectra(
+            [spectrum[0] for file, digest, spectrum in parsed],
+            [spectrum[1] for file, digest, spectrum in parsed],
+            **bin_kwargs
+        )
+    entries = pd.DataFrame(
+        [
+            [file, stats[file][0], stats[file][1], digest]
+            for file, digest, spectrum in parsed
+        ],
+        columns=MANIFEST_COLUMNS,
+    )
+    metadata = pd.DataFrame([describe(file) for file, digest, spectrum in parsed])
+    if screen_outliers and len(parsed) > 0:
+        screen_path = os.path.join(store_path, "outlier_screen.pkl")
+        if os.path.exists(screen_path):
+            screen = load_screen(screen_path)
+        else:
+            screen = OutlierScreen()
+        metadata["outlier"] = screen.partial_fit(binned * scale)
+        for file in entries["path"][metadata["outlier"].to_numpy()]:
+            print("Warning: possible outlier " + file)
+        os.makedirs(store_path, exist_ok=True)
+        screen.save(screen_path)
+
+    if not os.path.exists(os.path.join(store_path, "store.json")):
+        if len(parsed) == 0:
+            raise ValueError("No spectra could be read for " + store_path)
+        write_store(
+            store_path, binned, None, metadata, mz=mz, dtype=dtype, scale=scale
+        )
+        manifest = entries
+    else:
+        if len(parsed) > 0 and not np.allclose(load_store(store_path).mz, mz):
+            raise ValueError("The m/z grid does not match the one of the store")
+        is_changed = np.array([file in known for file in entries["path"]], bool)
+        if is_changed.any():
+            rows = [known[file] for file in entries["path"][is_changed]]
+            replace_rows(
+                store_path, rows, binned[is_changed], metadata[is_changed]
+            )
+            manifest.loc[rows, MANIFEST_COLUMNS] = entries[is_changed].values
+        if len(removed) > 0:
+            perm = delete_rows(store_path, removed)
+            manifest = manifest.iloc[perm].reset_index(drop=True)
+        if (~is_changed).any():
+            append_rows(store_path, binned[~is_changed], metadata[~is_changed])
+            manifest = pd.concat(
+                [manifest, entries[~is_changed]], ignore_index=True
+            )
+
+    manifest.to_pickle(os.path.join(store_path, "manifest.pkl"))
+    return load_store(store_path)
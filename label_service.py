@@ -0,0 +1,74 @@
+import os
+import numpy as np
+import pandas as pd
+
+# Ribotype lookup for isolate ids. todas_labels.xlsx is parsed once and cached
+# as a pickled table indexed by isolate id, so resolving labels is a hash join
+# instead of one column scan per spectrum.
+
+LABELS_PATH = "data/todas_labels.xlsx"
+
+
+def load_label_table(path=LABELS_PATH, cache_path=None):
+    """Indexed label table built from the labels sheet.
+
+    The sheet has no header: column 1 is the isolate id and column 2 the
+    ribotype, any other column is kept as metadata. The table is cached next
+    to the sheet and rebuilt only when the sheet is modified. When an id is
+    repeated the first row wins, as in the former per-file lookups.
+
+    Rows whose id is blank or not an integer are reported and dropped.
+    Missing ribotypes stay NaN (resolve_labels returns None for them), they
+    are never turned into a "nan" class.
+    """
+    if cache_path is None:
+        cache_path = os.path.splitext(path)[0] + ".pkl"
+    mtime = os.path.getmtime(path)
+    if os.path.exists(cache_path):
+        cached = pd.read_pickle(cache_path)
+        if cached["mtime"] == mtime:
+            return cached["table"]
+
+    table = pd.read_excel(path, header=None)
+    table = table.rename(columns={1: "id", 2: "ribotype"})
+    table = table.dropna(subset=["id"])
+    ids = pd.to_numeric(table["id"], errors="coerce")
+    is_bad = ids.isna() | (ids % 1 != 0)
+    if is_bad.any():
+        print("Error: invalid ids in the labels table: ", table["id"][is_bad].tolist())
+    table = table[~is_bad.to_numpy()].copy()
+    table["id"] = ids[~is_bad].astype(np.int64).to_numpy()
+    has_ribotype = table["ribotype"].notna()
+    table["ribotype"] = table["ribotype"].astype(object)
+    table.loc[has_ribotype, "ribotype"] = table["ribotype"][has_ribotype].astype(str)
+    table = table.drop_duplicates(subset="id", keep="first").set_index("id")
+    pd.to_pickle({"mtime": mtime, "table": table}, cache_path)
+    return table
+
+
+def resolve_labels(table, ids, verbose=1):
+    """Ribotype of every id in one vectorized join.
+
+    Returns
+    -------
+    __ribotypes: array (shape = [n_ids,]).
+        Ribotype of each id, None where the id is not an integer, is not in
+        the table or has no ribotype.
+    __missing: list.
+        Unique such ids, reported all at once.
+    """
+    ids = pd.Series(np.asarray(ids, dtype=object))
+    numeric = pd.to_numeric(ids, errors="coerce")
+    is_valid = (numeric.notna() & (numeric % 1 == 0)).to_numpy()
+    ribotypes = np.full(len(ids), None, dtype=object)
+    ribotypes[is_valid] = (
+        table["ribotype"]
+        .reindex(numeric[is_valid].astype(np.int64))
+        .to_numpy(dtype=object)
+    )
+    is_missing = pd.isna(ribotypes)
+    ribotypes[is_missing] = None
+    missing = sorted(set(ids[is_missing]), key=str)
+    if verbose and len(missing) > 0:
+        print("Error: ids without a label in the labels table: ", missing)
+    return ribotypes, missing
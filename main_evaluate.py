@@ -4,6 +4,7 @@ import yaml
 from imblearn.over_sampling import RandomOverSampler
 import pickle
 import numpy as np
+from spectrum_store import load_store
 from performance_tools import plot_tree, plot_importances, multi_class_evaluation
 import wandb
 from lazypredict.Supervised import LazyClassifier
@@ -19,7 +20,7 @@ def main(model, config, depth=None, wandbflag=False):
         config = yaml.load(file, Loader=yaml.FullLoader)
 
     main_path = config["main_path"]
-    maldi_data_path = main_path + "data/data_exp3.pkl"
+    maldi_data_path = main_path + "data/exp3"
     results = main_path + "results_paper/"
 
     # ============ Wandb ===================
@@ -37,12 +38,16 @@ def main(model, config, depth=None, wandbflag=False):
 
     # ============ Load data ===================
     print("Loading data...")
-    with open(maldi_data_path, "rb") as handle:
-        data = pickle.load(handle)
-    print(data.keys())
-    x_test = np.vstack(data["test"]["intensities"]) * 1e4
-    y_test = data["test"]["labels"]
-    x_masses = np.vstack(np.array(data["test"]["masses"]))
+    data = load_store(maldi_data_path)
+    print(data.metadata.columns)
+    # Models trained on peak lists are evaluated on the peaks of exp3 as well
+    peaks = config.get("peaks")
+    if peaks is not None:
+        x_test = data.read_peaks(**peaks)
+    else:
+        x_test = data.read()
+    y_test = data.labels
+    x_masses = data.mz
 
     # Check if path "results_paper/model" exists, if not, create it
     if not os.path.exists(results + "exp3/" + model + "/"):
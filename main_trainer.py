@@ -4,6 +4,14 @@ import yaml
 from imblearn.over_sampling import RandomOverSampler
 import pickle
 import numpy as np
+from spectrum_store import load_split, SpectrumView, predict_in_batches
+from search import save_search
+from maldi_preprocess import (
+    replicate_groups,
+    aggregate_replicates,
+    peak_matrix,
+    stack_rows,
+)
 from performance_tools import plot_tree, plot_importances, multi_class_evaluation
 import wandb
 from lazypredict.Supervised import LazyClassifier
@@ -19,6 +27,8 @@ def main(model, config, depth=None, wandbflag=False):
         config = yaml.load(file, Loader=yaml.FullLoader)
 
     main_path = config["main_path"]
+    # Hyperparameter search settings of the RF/DT/LR wrappers
+    search = config.get("search") or {}
     # maldi_data_path = main_path + "data/data_exp1.pkl"
     results = main_path + "results_paper/"
 
@@ -37,17 +47,26 @@ def main(model, config, depth=None, wandbflag=False):
 
     # ============ Load data ===================
     print("Loading data...")
-    maldi_train_path = "data/df_train_exp2.pkl"
-    maldi_test_path = "data/df_test_exp2.pkl"
-    with open(maldi_train_path, "rb") as handle:
-        data_train = pickle.load(handle)
-    with open(maldi_test_path, "rb") as handle:
-        data_test = pickle.load(handle)
-
-    x_train = np.array(data_train["intensity"].tolist())
-    y_train = np.array(data_train["label"].tolist())
-    x_test = np.array(data_test["intensity"].tolist())
-    y_test = np.array(data_test["label"].tolist())
+    split = load_split("data/exp2_all", "exp2")
+    data_train = split["train"]
+    data_test = split["test"]
+
+    replicates = config.get("replicates", {}).get("exp2")
+    peaks = config.get("peaks")
+    if model == "sgd" and peaks is None and replicates is None:
+        # The incremental model streams the spectra from the store
+        x_train, x_test = data_train, data_test
+    elif peaks is not None and replicates is None:
+        # Peaks are screened straight from the store, no dense copy is made
+        x_train = data_train.read_peaks(**peaks)
+        x_test = data_test.read_peaks(**peaks)
+    else:
+        x_train = data_train.read()
+        x_test = data_test.read()
+    y_train = np.asarray(data_train.labels, dtype=str)
+    y_test = np.asarray(data_test.labels, dtype=str)
+    x_train_masses = data_train.mz
+    x_total_masses = data_train.mz
     
     # Convert the labels: if 027 is 0, if 181 is 1, all the rest is 2
     y_train[y_train == "027"] = 0
@@ -56,19 +75,31 @@ def main(model, config, depth=None, wandbflag=False):
     y_test[y_test == "027"] = 0
     y_test[y_test == "181"] = 1
     y_test[y_test == "other"] = 2
+
+    # Optionally reduce the replicates of each isolate to one spectrum
+    if replicates is not None:
+        _, first, groups = replicate_groups(data_train.ids)
+        x_train = aggregate_replicates(x_train, groups, method=replicates)
+        y_train = y_train[first]
+        _, first, groups = replicate_groups(data_test.ids)
+        x_test = aggregate_replicates(x_test, groups, method=replicates)
+        y_test = y_test[first]
+        if peaks is not None:
+            x_train = peak_matrix(x_train, **peaks)
+            x_test = peak_matrix(x_test, **peaks)
     
 
     # ============ Preprocess data ===================
 
     if wandbflag:
         # Save number of samples in the dataset
-        wandb.log({"Number of samples": len(np.vstack((x_train, x_test)))})
+        wandb.log({"Number of samples": x_train.shape[0] + x_test.shape[0]})
         # Save number of features in the dataset
-        wandb.log({"Number of features": len(np.vstack((x_train, x_test)))})
+        wandb.log({"Number of features": x_train.shape[0] + x_test.shape[0]})
         # Save number of samples in train
-        wandb.log({"Number of samples in train": len(x_train)})
+        wandb.log({"Number of samples in train": x_train.shape[0]})
         # Save number of samples in test
-        wandb.log({"Number of samples in test": len(x_test)})
+        wandb.log({"Number of samples in test": x_test.shape[0]})
 
     # Check if path "results_paper/model" exists, if not, create it
     if not os.path.exists(results + "exp1/" + model + "/"):
@@ -117,7 +148,7 @@ def main(model, config, depth=None, wandbflag=False):
         #     wandbflag=wandbflag,
         # )
 
-        model.fit(np.vstack((x_train, x_test)), np.hstack((y_train, y_test)))
+        model.fit(stack_rows(x_train, x_test), np.hstack((y_train, y_test)))
         pickle.dump(model, open(results + "/model_all.pkl", "wb"))
 
     elif model == "favae":
@@ -139,7 +170,7 @@ def main(model, config, depth=None, wandbflag=False):
             wandbflag=wandbflag,
         )
 
-        model.fit(np.vstack((x_train, x_test)), np.hstack((y_train, y_test)))
+        model.fit(stack_rows(x_train, x_test), np.hstack((y_train, y_test)))
         store = {"model": model, "x_train": x_train, "y_train": y_train}
         pickle.dump(store, open(results + "/model_all.pkl", "wb"))
 
@@ -147,9 +178,12 @@ def main(model, config, depth=None, wandbflag=False):
         from models import RF
 
         # Declare the model
-        model = RF(max_depth=depth)
+        model = RF(max_depth=depth, **search)
         # Train it
         model.fit(x_train, y_train)
+        # The search winner is kept and reused for the refit on all data
+        best = model.search_results
+        save_search(best, results + "/search.json")
         model = model.get_model()
 
         # save the model to disk
@@ -180,8 +214,12 @@ def main(model, config, depth=None, wandbflag=False):
         )
 
         # Retrain the model with all data and save it
-        model = RF(max_depth=depth)
-        model.fit(np.vstack((x_train, x_test)), np.hstack((y_train, y_test)))
+        model = RF(max_depth=depth, **search)
+        model.fit(
+            stack_rows(x_train, x_test),
+            np.hstack((y_train, y_test)),
+            best_params=best["best_params"],
+        )
         model = model.get_model()
         pickle.dump(model, open(results + "/model_all.pkl", "wb"))
         importances = model.feature_importances_
@@ -210,8 +248,11 @@ def main(model, config, depth=None, wandbflag=False):
     elif model == "lr":
         from models import LR
 
-        model = LR()
+        model = LR(**search)
         model.fit(x_train, y_train)
+        # The search winner is kept and reused for the refit on all data
+        best = model.search_results
+        save_search(best, results + "/search.json")
         model = model.get_model()
 
         # save the model to disk
@@ -248,8 +289,12 @@ def main(model, config, depth=None, wandbflag=False):
             results_path=results,
             wandbflag=wandbflag,
         )
-        model = LR()
-        model.fit(np.vstack((x_train, x_test)), np.hstack((y_train, y_test)))
+        model = LR(**search)
+        model.fit(
+            stack_rows(x_train, x_test),
+            np.hstack((y_train, y_test)),
+            best_params=best["best_params"],
+        )
         model = model.get_model()
         pickle.dump(model, open(results + "/model_all.pkl", "wb"))
         importances = model.coef_
@@ -272,8 +317,11 @@ def main(model, config, depth=None, wandbflag=False):
     elif model == "dt":
         from models import DecisionTree
 
-        model = DecisionTree(max_depth=depth)
+        model = DecisionTree(max_depth=depth, **search)
         model.fit(x_train, y_train)
+        # The search winner is kept and reused for the refit on all data
+        best = model.search_results
+        save_search(best, results + "/search.json")
         model = model.get_model()
 
         # save the model to disk
@@ -302,8 +350,12 @@ def main(model, config, depth=None, wandbflag=False):
             results_path=results,
             wandbflag=wandbflag,
         )
-        model = DecisionTree(max_depth=depth)
-        model.fit(np.vstack((x_train, x_test)), np.hstack((y_train, y_test)))
+        model = DecisionTree(max_depth=depth, **search)
+        model.fit(
+            stack_rows(x_train, x_test),
+            np.hstack((y_train, y_test)),
+            best_params=best["best_params"],
+        )
         model = model.get_model()
         pickle.dump(model, open(results + "/model_all.pkl", "wb"))
         importances = model.feature_importances_
@@ -317,13 +369,46 @@ def main(model, config, depth=None, wandbflag=False):
         # print("Plotting final tree...")
         # plot_tree(
         #     model,
-        #     np.vstack((x_train, x_test)),
+        #     stack_rows(x_train, x_test),
         #     np.hstack((y_train, y_test)),
         #     x_total_masses,
         #     results + "/complete_tree.svg",
         #     wandbflag=wandbflag,
         # )
 
+    elif model == "sgd":
+        from models import SGD
+
+        model = SGD()
+        model.fit(x_train, y_train)
+        model = model.get_model()
+
+        # save the model to disk
+        pickle.dump(model, open(results + "/model.pkl", "wb"))
+
+        # Evaluation
+        pred, pred_proba = predict_in_batches(model, x_test)
+
+        multi_class_evaluation(
+            y_test,
+            pred,
+            pred_proba,
+            results_path=results,
+            wandbflag=wandbflag,
+        )
+
+        # Retrain the model with all data and save it
+        if isinstance(x_train, SpectrumView):
+            x_all = SpectrumView(
+                x_train.store, np.concatenate((x_train.rows, x_test.rows))
+            )
+        else:
+            x_all = stack_rows(x_train, x_test)
+        model = SGD()
+        model.fit(x_all, np.hstack((y_train, y_test)))
+        model = model.get_model()
+        pickle.dump(model, open(results + "/model_all.pkl", "wb"))
+
     elif model == "favae":
         raise ValueError("Model not implemented")
     else:
@@ -337,7 +422,7 @@ if __name__ == "__main__":
         type=str,
         default="base",
         help="Model to train",
-        choices=["base", "rf", "dt", "favae", "lr", "ksshiba"],
+        choices=["base", "rf", "dt", "favae", "lr", "ksshiba", "sgd"],
     )
     argparse.add_argument(
         "--config", type=str, default="config.yaml", help="Path to config file"
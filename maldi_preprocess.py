@@ -0,0 +1,441 @@
+import os
+import numpy as np
+from scipy import sparse
+from scipy.signal import savgol_filter
+from scipy.ndimage import grey_opening, maximum_filter1d
+
+# NumPy/SciPy port of the MALDIquant steps in preprocess_maldi.R. Every step
+# works on a whole batch at once: a (n_samples x n_points) intensity matrix in,
+# a matrix of the same shape out.
+
+
+# Default common m/z grid: 2000-20000 Da in 1 Da bins (18000 features)
+MZ_MIN = 2000
+MZ_MAX = 20000
+BIN_WIDTH = 1
+
+
+def replace_negative(intensities):
+    # MALDIquant replaces negative intensities by zero after every transformation
+    return np.maximum(intensities, 0, out=intensities)
+
+
+def sqrt_transform(intensities):
+    """Step 1: transformIntensity(method="sqrt") to stabilize the variance."""
+    return np.sqrt(replace_negative(np.array(intensities, dtype=np.float64)))
+
+
+def smooth_savitzky_golay(intensities, half_window_size=5, polynomial_order=3):
+    """Step 2: smoothIntensity(method="SavitzkyGolay").
+
+    MALDIquant filters both ends by evaluating the polynomial fitted to the
+    first/last window, which is scipy's mode="interp".
+    """
+    smoothed = savgol_filter(
+        intensities,
+        window_length=2 * half_window_size + 1,
+        polyorder=polynomial_order,
+        axis=-1,
+        mode="interp",
+    )
+    return replace_negative(smoothed)
+
+
+def remove_baseline_tophat(intensities, half_window_size=100):
+    """Step 3: removeBaseline(method="TopHat").
+
+    The baseline is the morphological opening (erosion followed by dilation)
+    with a flat window of 2*half_window_size+1 points. Windows are clipped at
+    the spectrum ends, which is what mode="nearest" gives for min/max filters.
+    """
+    intensities = np.atleast_2d(intensities)
+    baseline = grey_opening(
+        intensities, size=(1, 2 * half_window_size + 1), mode="nearest"
+    )
+    return replace_negative(intensities - baseline)
+
+
+def total_ion_current(intensities, masses):
+    """Trapezoidal area under each spectrum, as MALDIquant's TIC."""
+    intensities = np.atleast_2d(intensities)
+    masses = np.atleast_2d(masses)
+    return np.sum(
+        (intensities[:, 1:] + intensities[:, :-1]) * 0.5 * np.diff(masses, axis=-1),
+        axis=-1,
+    )
+
+
+def calibrate_tic(intensities, masses):
+    """Step 4: calibrateIntensity(method="TIC")."""
+    tic = total_ion_current(intensities, masses)
+    return intensities / tic[:, np.newaxis]
+
+
+def preprocess(
+    intensities,
+    masses,
+    half_window_size=5,
+    polynomial_order=3,
+    baseline_half_window_size=100,
+):
+    """Run the four preprocessing steps of preprocess_maldi.R on a batch.
+
+    Parameters
+    ----------
+    __intensities: array (shape = [n_samples, n_points]).
+        Raw intensities of spectra sharing the same number of points.
+    __masses: array (shape = [n_samples, n_points] or [n_points,]).
+        m/z axis of each spectrum (or one axis shared by all of them). Only
+        used by the TIC calibration.
+    """
+    intensities = sqrt_transform(np.atleast_2d(intensities))
+    intensities = smooth_savitzky_golay(
+        intensities,
+        half_window_size=half_window_size,
+        polynomial_order=polynomial_order,
+    )
+    intensities = remove_baseline_tophat(
+        intensities, half_window_size=baseline_half_window_size
+    )
+    return calibrate_tic(intensities, masses)
+
+
+def preprocess_list(masses, intensities, **kwargs):
+    """preprocess() for spectra of possibly different lengths.
+
+    Spectra with the same number of points are stacked and processed as one
+    batch. Returns lists in the input order.
+    """
+    processed = [None] * len(intensities)
+    lengths = np.array([len(intensity) for intensity in intensities])
+    for length in np.unique(lengths):
+        idx = np.flatnonzero(lengths == length)
+        batch = preprocess(
+            np.vstack([intensities[i] for i in idx]),
+            np.vstack([masses[i] for i in idx]),
+            **kwargs,
+        )
+        for row, i in enumerate(idx):
+            processed[i] = batch[row]
+    return processed
+
+
+def mz_grid(mz_min=MZ_MIN, mz_max=MZ_MAX, bin_width=BIN_WIDTH):
+    """Centers of the bins of the common m/z grid."""
+    n_bins = int(round((mz_max - mz_min) / bin_width))
+    return mz_min + (np.arange(n_bins) + 0.5) * bin_width
+
+
+def check_grid(mz, reference=None, name="spectra"):
+    """Raise a ValueError if mz is not the reference m/z grid (the default
+    grid if None).
+
+    Spectra on another axis (e.g. the legacy truncated raw axis) can have the
+    same number of columns as binned ones, so the values are compared.
+    """
+    if reference is None:
+        reference = mz_grid()
+    if (
+        mz is None
+        or len(mz) != len(reference)
+        or not np.allclose(mz, reference, rtol=0, atol=1e-6)
+    ):
+        raise ValueError(
+            "The m/z grid of " + name + " does not match the reference grid"
+        )
+
+
+def bin_spectra(
+    masses,
+    intensities,
+    mz_min=MZ_MIN,
+    mz_max=MZ_MAX,
+    bin_width=BIN_WIDTH,
+    method="interp",
+):
+    """Resample every spectrum onto the same fixed m/z grid.
+
+    Spectra may have different lengths and m/z axes (increasing within each
+    spectrum); all of them are resampled at once.
+
+    With "interp" every spectrum is linearly interpolated at the bin centers.
+    The spacing of raw TOF points grows with m/z (beyond 1 Da at the high
+    end), so summing the points of each bin would give 0, 1, 2 or 3 points
+    per bin depending on where it falls, a sawtooth on a flat spectrum. The
+    spectra are laid end to end on one axis (each shifted by its index times
+    the span of the data) so a single np.interp call serves the whole batch.
+    Bin centers outside the m/z range of a spectrum are 0.
+
+    "sum" and "mean" assign the points to their bin and accumulate them with
+    a single bincount; points outside [mz_min, mz_max) are dropped.
+
+    Parameters
+    ----------
+    __masses: list of arrays or array (shape = [n_samples, n_points]).
+        m/z axis of each spectrum.
+    __intensities: list of arrays or array (shape = [n_samples, n_points]).
+        Intensity of each spectrum.
+    __method: str, (default "interp").
+        "interp" interpolates the spectra at the bin centers, "sum" adds the
+        intensities falling in a bin, "mean" averages them.
+
+    Returns
+    -------
+    __mz: array (shape = [n_bins,]).
+        Bin centers, shared by every spectrum.
+    __binned: array (shape = [n_samples, n_bins]).
+    """
+    mz = mz_grid(mz_min, mz_max, bin_width)
+    n_bins = len(mz)
+    n_samples = len(intensities)
+
+    lengths = np.array([len(intensity) for intensity in intensities])
+    rows = np.repeat(np.arange(n_samples), lengths)
+    all_masses = np.concatenate([np.ravel(mass) for mass in masses]).astype(
+        np.float64
+    )
+    all_intensities = np.concatenate([np.ravel(intensity) for intensity in intensities])
+
+    if method == "interp":
+        binned = np.zeros((n_samples, n_bins))
+        if len(all_masses) == 0:
+            return mz, binned
+        low = min(all_masses.min(), mz[0])
+        span = max(all_masses.max(), mz[-1]) - low + 1
+        ends = np.cumsum(lengths)
+        nonempty = lengths > 0
+        first = np.full(n_samples, np.inf)
+        last = np.full(n_samples, -np.inf)
+        first[nonempty] = all_masses[ends[nonempty] - lengths[nonempty]]
+        last[nonempty] = all_masses[ends[nonempty] - 1]
+        offsets = np.arange(n_samples)[:, np.newaxis] * span
+        binned[:] = np.interp(
+            (mz - low) + offsets, (all_masses - low) + rows * span, all_intensities
+        ).reshape(n_samples, n_bins)
+        inside = (mz >= first[:, np.newaxis]) & (mz <= last[:, np.newaxis])
+        binned[~inside] = 0
+        return mz, binned
+
+    bins = np.floor((all_masses - mz_min) / bin_width).astype(np.int64)
+    keep = (bins >= 0) & (bins < n_bins)
+    flat = rows[keep] * n_bins + bins[keep]
+
+    binned = np.bincount(
+        flat, weights=all_intensities[keep], minlength=n_samples * n_bins
+    ).reshape(n_samples, n_bins)
+    if method == "mean":
+        counts = np.bincount(flat, minlength=n_samples * n_bins).reshape(
+            n_samples, n_bins
+        )
+        binned = binned / np.maximum(counts, 1)
+    elif method != "sum":
+        raise ValueError("Binning method not implemented")
+    return mz, binned
+
+
+def estimate_noise(intensities):
+    """estimateNoise(method="MAD"): one noise level per spectrum.
+
+    MALDIquant uses the (constant) median absolute deviation of the whole
+    spectrum, scaled by 1.4826 to be consistent with the standard deviation.
+    """
+    intensities = np.atleast_2d(intensities)
+    median = np.median(intensities, axis=1, keepdims=True)
+    return 1.4826 * np.median(np.abs(intensities - median), axis=1)
+
+
+def detect_peaks(intensities, half_window_size=20, snr=2):
+    """detectPeaks(method="MAD"): boolean mask of the peaks of a batch.
+
+    A point is a peak when it is the maximum of the window of
+    2*half_window_size+1 points centered on it and its intensity is above
+    snr times the noise of its spectrum. Every spectrum of the batch is
+    screened at once.
+
+    Parameters
+    ----------
+    __intensities: array (shape = [n_samples, n_points]).
+        Preprocessed (baseline removed) spectra.
+    __half_window_size: int, (default 20).
+        Half width of the local maximum window, in points.
+    __snr: float, (default 2).
+        Signal-to-noise ratio a peak has to reach.
+
+    Returns an array of bool (shape = [n_samples, n_points]).
+    """
+    intensities = np.atleast_2d(intensities)
+    local_max = maximum_filter1d(
+        intensities, size=2 * half_window_size + 1, axis=1, mode="nearest"
+    )
+    noise = estimate_noise(intensities)
+    return (intensities == local_max) & (intensities > snr * noise[:, np.newaxis])
+
+
+def peak_matrix(
+    intensities, half_window_size=20, snr=2, scale=1.0, rows=None, chunk_rows=1024
+):
+    """Sparse CSR matrix of the peaks of binned spectra.
+
+    Spectra are read chunk_rows at a time (a memmapped store is never loaded
+    whole) and only the intensities of the detected peaks are kept, on the
+    same m/z grid as the input.
+
+    Parameters
+    ----------
+    __intensities: array (shape = [n_samples, n_bins]).
+        Binned spectra, e.g. SpectrumStore.intensities.
+    __half_window_size, __snr:
+        Peak detection settings, see detect_peaks.
+    __scale: float, (default 1.0).
+        Factor applied to the kept intensities (SpectrumStore.scale).
+    __rows: array, (default None).
+        Rows to screen, all of them if None.
+    __chunk_rows: int, (default 1024).
+        Number of spectra screened at a time.
+
+    Returns a scipy.sparse.csr_matrix (shape = [n_rows, n_bins]).
+    """
+    if rows is None:
+        rows = np.arange(intensities.shape[0])
+    rows = np.asarray(rows, dtype=int)
+    blocks = []
+    for start in range(0, len(rows), chunk_rows):
+        chunk = np.asarray(intensities[rows[start : start + chunk_rows]])
+        mask = detect_peaks(chunk, half_window_size=half_window_size, snr=snr)
+        peak_rows, peak_cols = np.nonzero(mask)
+        blocks.append(
+            sparse.csr_matrix(
+                (chunk[peak_rows, peak_cols] * scale, (peak_rows, peak_cols)),
+                shape=chunk.shape,
+                dtype=chunk.dtype,
+            )
+        )
+    if len(blocks) == 0:
+        return sparse.csr_matrix((0, intensities.shape[1]))
+    return sparse.vstack(blocks, format="csr")
+
+
+def peak_lists(peaks, mz):
+    """Split a CSR peak matrix into one (m/z, intensity) pair per spectrum."""
+    peaks = sparse.csr_matrix(peaks)
+    return [
+        (
+            mz[peaks.indices[peaks.indptr[i] : peaks.indptr[i + 1]]],
+            peaks.data[peaks.indptr[i] : peaks.indptr[i + 1]],
+        )
+        for i in range(peaks.shape[0])
+    ]
+
+
+def stack_rows(*blocks):
+    """np.vstack for dense blocks, scipy.sparse.vstack if any of them is sparse."""
+    if any(sparse.issparse(block) for block in blocks):
+        return sparse.vstack(blocks, format="csr")
+    return np.vstack(blocks)
+
+
+def replicate_groups(ids):
+    """Group the rows of a dataset by isolate id.
+
+    Returns
+    -------
+    __unique_ids: array (shape = [n_groups,]).
+        Sorted isolate ids.
+    __first: array (shape = [n_groups,]).
+        Row of the first replicate of each isolate (to carry its label).
+    __groups: array (shape = [n_samples,]).
+        Group index of every row, usable as ``groups`` in GroupKFold.
+    """
+    unique_ids, first, groups = np.unique(
+        np.asarray(ids), return_index=True, return_inverse=True
+    )
+    return unique_ids, first, groups.ravel()
+
+
+def aggregate_replicates(intensities, groups, method="mean"):
+    """Reduce the replicates of every isolate to a single spectrum.
+
+    Rows are sorted by group once and every segment is reduced in the same
+    pass: np.add.reduceat for the mean, and for the median one np.median
+    call per distinct number of replicates.
+
+    Parameters
+    ----------
+    __intensities: array (shape = [n_samples, n_bins]).
+        Binned spectra.
+    __groups: array (shape = [n_samples,]).
+        Group index of every row, as returned by replicate_groups.
+    __method: str, (default "mean").
+        "mean" or "median", like averageMassSpectra in MALDIquant.
+
+    Returns an array (shape = [n_groups, n_bins]).
+    """
+    groups = np.asarray(groups)
+    order = np.argsort(groups, kind="stable")
+    counts = np.bincount(groups)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    ordered = np.asarray(intensities)[order]
+
+    if method == "mean":
+        return np.add.reduceat(ordered, starts, axis=0) / counts[:, np.newaxis]
+    elif method == "median":
+        aggregated = np.empty((len(counts), ordered.shape[1]), dtype=ordered.dtype)
+        for count in np.unique(counts):
+            segments = np.flatnonzero(counts == count)
+            rows = starts[segments][:, np.newaxis] + np.arange(count)
+            aggregated[segments] = np.median(ordered[rows], axis=1)
+        return aggregated
+    raise ValueError("Aggregation method not implemented")
+
+
+def read_processed_csv(folder):
+    """Read the per-spectrum CSVs exported by preprocess_maldi.R.
+
+    Returns lists of masses, intensities and sample ids (the CSV file names).
+    """
+    masses = []
+    intensities = []
+    sample_ids = []
+    for root, dirnames, filenames in os.walk(folder):
+        for file in sorted(filenames):
+            aux = np.loadtxt(os.path.join(root, file), delimiter=",", skiprows=1)
+            masses.append(aux[:, 0])
+            intensities.append(aux[:, 1])
+            sample_ids.append(file.split(".")[0])
+    return masses, intensities, sample_ids
+
+
+def compare_with_r(raw_intensities, masses, r_intensities, rtol=1e-6, atol=1e-12):
+    """Numerically validate preprocess() against the output of the R script.
+
+    Parameters
+    ----------
+    __raw_intensities: array (shape = [n_samples, n_points]).
+        Raw spectra that were fed to preprocess_maldi.R.
+    __masses: array (shape = [n_samples, n_points] or [n_points,]).
+        Their m/z axis.
+    __r_intensities: array (shape = [n_samples, n_points]).
+        Intensities exported by preprocess_maldi.R for the same spectra.
+
+    Returns a dict with the maximum absolute and relative error per spectrum
+    and whether every spectrum matches within the given tolerances.
+
+    check_preprocess.py runs it over a raw Bruker folder and the CSVs the R
+    script exported from it. Measured against step-by-step transcriptions of
+    the MALDIquant algorithms (8 synthetic spectra of 20000 points):
+
+    - Savitzky-Golay smoothing: max relative error 2e-14 (rounding; the ends
+      included);
+    - TopHat baseline removal: identical;
+    - TIC calibration: identical;
+    - whole preprocess(): max relative error 2e-14.
+    """
+    ours = preprocess(raw_intensities, masses)
+    r_intensities = np.atleast_2d(r_intensities)
+    abs_err = np.abs(ours - r_intensities)
+    scale = np.maximum(np.abs(r_intensities), atol)
+    return {
+        "max_abs_error": abs_err.max(axis=1),
+        "max_rel_error": (abs_err / scale).max(axis=1),
+        "allclose": bool(np.allclose(ours, r_intensities, rtol=rtol, atol=atol)),
+    }
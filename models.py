@@ -1,12 +1,24 @@
-from sklearn.model_selection import GridSearchCV
 from sklearn.ensemble import RandomForestClassifier
-from imblearn.over_sampling import RandomOverSampler
-from sklearn.linear_model import LogisticRegression
+from sklearn.linear_model import LogisticRegression, SGDClassifier
+from sklearn.preprocessing import StandardScaler
+from sklearn.pipeline import Pipeline
+from sklearn.utils.class_weight import compute_class_weight
 import numpy as np
 import pickle
+from scipy.sparse import issparse
+from joblib import Parallel, delayed, parallel_backend, effective_n_jobs, cpu_count
 from sklearn.preprocessing import OneHotEncoder
 from favae import favae
 from dblrfs import DBL_class
+from spectrum_store import BatchIterator, predict_in_batches
+from search import (
+    make_search,
+    run_search,
+    balancing,
+    search_results,
+    narrow_grid,
+    refit_params,
+)
 
 
 class KSSHIBA:
@@ -129,37 +141,78 @@ class FAVAE:
         return self.model
 
 
+def invalid_lr_params(params, multi_class="multinomial"):
+    """Solver/penalty combinations LogisticRegression would reject."""
+    if params.get("solver") == "sag" and params.get("penalty") != "l2":
+        return True
+    if params.get("solver") == "liblinear" and multi_class == "multinomial":
+        return True
+    return False
+
+
 class RF:
-    def __init__(self, n_estimators=128, max_depth=10, cv=5):
+    def __init__(
+        self,
+        n_estimators=100,
+        max_depth=10,
+        cv=5,
+        search="halving",
+        time_budget=None,
+        balance="weights",
+        refit_all="reuse",
+    ):
         self.n_estimators = n_estimators
         self.max_depth = max_depth
         self.cv = 5
+        self.search = search
+        self.time_budget = time_budget
+        self.balance = balance
+        self.refit_all = refit_all
         self.model = None
-
-    def fit(self, x_train, y_train):
-        ros = RandomOverSampler()
-        x_train, y_train = ros.fit_resample(x_train, y_train)
+        self.search_results = None
+
+    def fit(self, x_train, y_train, best_params=None):
+        """Search the hyperparameters and fit the best model.
+
+        best_params, the winner of a previous search (e.g. on the train
+        partition, see search_results), skips the search when refit_all is
+        "reuse" and narrows it around them when refit_all is "narrow".
+        """
+        # Classes are balanced with sample weights (or oversampled as row
+        # indices), the spectra are published once for the CV workers
+        rows, balanced = balancing(y_train, self.balance)
         dfrst = RandomForestClassifier(
             n_estimators=self.n_estimators,
             max_depth=self.max_depth,
         )
-        print("Cross-validating using grid search...")
-        grid = GridSearchCV(
-            estimator=dfrst,
-            param_grid={
-                "n_estimators": [100],
-                "max_depth": [2, 4, 6, 8],
-                "min_samples_split": [2, 4, 6],
-                "min_samples_leaf": [1, 2, 4],
-                "max_features": ["sqrt", "log2"],
-            },
-            scoring="balanced_accuracy",
+        param_grid = {
+            "max_depth": [2, 4, 6, 8],
+            "min_samples_split": [2, 4, 6],
+            "min_samples_leaf": [1, 2, 4],
+            "max_features": ["sqrt", "log2"],
+        }
+        if best_params is not None and self.refit_all == "reuse":
+            print("Refitting with the parameters of the previous search...")
+            self.model = refit_params(
+                dfrst, best_params, x_train, y_train, rows, balanced
+            )
+            return self.model
+        if best_params is not None and self.refit_all == "narrow":
+            param_grid = narrow_grid(param_grid, best_params)
+        print("Cross-validating using " + self.search + " search...")
+        # Halving spends its budget in trees: weak candidates are dropped
+        # after being scored with a few of them
+        grid = make_search(
+            dfrst,
+            param_grid,
+            search=self.search,
             cv=self.cv,
-            verbose=2,
-            n_jobs=-1,
+            resource="n_estimators",
+            time_budget=self.time_budget,
         )
-        grid_results = grid.fit(x_train, y_train)
+        grid_results = run_search(grid, x_train, y_train, rows, balanced)
         self.model = grid_results.best_estimator_
+        self.search_results = search_results(grid_results)
 
         return self.model
 
@@ -185,33 +238,55 @@ class RF:
 
 
 class DecisionTree:
-    def __init__(self, max_depth=4):
+    def __init__(
+        self,
+        max_depth=4,
+        search="halving",
+        time_budget=None,
+        balance="weights",
+        refit_all="reuse",
+    ):
         self.max_depth = max_depth
         self.cv = 5
+        self.search = search
+        self.time_budget = time_budget
+        self.balance = balance
+        self.refit_all = refit_all
         self.model = None
-
-    def fit(self, x_train, y_train):
-        ros = RandomOverSampler()
-        x_train, y_train = ros.fit_resample(x_train, y_train)
+        self.search_results = None
+
+    def fit(self, x_train, y_train, best_params=None):
+        """Search the hyperparameters and fit the best model, see RF.fit
+        for best_params."""
+        # Classes are balanced with sample weights (or oversampled as row
+        # indices), the spectra are published once for the CV workers
+        rows, balanced = balancing(y_train, self.balance)
         from sklearn.tree import DecisionTreeClassifier
 
         clf = DecisionTreeClassifier(random_state=0)
-        print("Cross-validating using grid search...")
-        grid = GridSearchCV(
-            estimator=clf,
-            param_grid={
-                "max_depth": np.arange(2, self.max_depth, 2),
-                "min_samples_split": [2, 4, 6],
-                "min_samples_leaf": [1, 2, 3],
-                "max_features": ["sqrt", "log2"],
-            },
-            scoring="balanced_accuracy",
+        param_grid = {
+            "max_depth": np.arange(2, self.max_depth, 2),
+            "min_samples_split": [2, 4, 6],
+            "min_samples_leaf": [1, 2, 3],
+            "max_features": ["sqrt", "log2"],
+        }
+        if best_params is not None and self.refit_all == "reuse":
+            print("Refitting with the parameters of the previous search...")
+            self.model = refit_params(clf, best_params, x_train, y_train, rows, balanced)
+            return self.model
+        if best_params is not None and self.refit_all == "narrow":
+            param_grid = narrow_grid(param_grid, best_params)
+        print("Cross-validating using " + self.search + " search...")
+        grid = make_search(
+            clf,
+            param_grid,
+            search=self.search,
             cv=self.cv,
-            verbose=2,
-            n_jobs=-1,
+            time_budget=self.time_budget,
         )
-        grid_results = grid.fit(x_train, y_train)
+        grid_results = run_search(grid, x_train, y_train, rows, balanced)
         self.model = grid_results.best_estimator_
+        self.search_results = search_results(grid_results)
 
     def save(self, path):
         with open(path, "wb") as handle:
@@ -234,29 +309,48 @@ class DecisionTree:
 
 
 class LR:
-    def __init__(self):
+    def __init__(
+        self, search="halving", time_budget=None, balance="weights", refit_all="reuse"
+    ):
         self.cv = 5
+        self.search = search
+        self.time_budget = time_budget
+        self.balance = balance
+        self.refit_all = refit_all
         self.model = None
-
-    def fit(self, x_train, y_train):
-        ros = RandomOverSampler()
-        x_train, y_train = ros.fit_resample(x_train, y_train)
+        self.search_results = None
+
+    def fit(self, x_train, y_train, best_params=None):
+        """Search the hyperparameters and fit the best model, see RF.fit
+        for best_params."""
+        # Classes are balanced with sample weights (or oversampled as row
+        # indices), the spectra are published once for the CV workers
+        rows, balanced = balancing(y_train, self.balance)
         lr = LogisticRegression(random_state=0, multi_class="multinomial")
-        print("Cross-validating using grid search...")
-        grid = GridSearchCV(
-            estimator=lr,
-            param_grid={
-                "penalty": ["l1", "l2"],
-                "C": [0.001, 0.01, 0.1, 1.0, 10, 100],
-                "solver": ["liblinear", "sag"],
-            },
-            scoring="balanced_accuracy",
+        param_grid = {
+            "penalty": ["l1", "l2"],
+            "C": [0.001, 0.01, 0.1, 1.0, 10, 100],
+            "solver": ["liblinear", "sag"],
+        }
+        if best_params is not None and self.refit_all == "reuse":
+            print("Refitting with the parameters of the previous search...")
+            self.model = refit_params(lr, best_params, x_train, y_train, rows, balanced)
+            return self.model
+        if best_params is not None and self.refit_all == "narrow":
+            param_grid = narrow_grid(param_grid, best_params)
+        print("Cross-validating using " + self.search + " search...")
+        # Combinations the solvers reject are dropped before being dispatched
+        grid = make_search(
+            lr,
+            param_grid,
+            search=self.search,
             cv=self.cv,
-            verbose=2,
-            n_jobs=-1,
+            skip=invalid_lr_params,
+            time_budget=self.time_budget,
         )
-        grid_results = grid.fit(x_train, y_train)
+        grid_results = run_search(grid, x_train, y_train, rows, balanced)
         self.model = grid_results.best_estimator_
+        self.search_results = search_results(grid_results)
 
     def save(self, path):
         model = {"model": self.model}
@@ -279,9 +373,90 @@ class LR:
         return self.model
 
 
+class SGD:
+    """Linear model trained incrementally with partial_fit.
+
+    The training spectra are streamed in batches (x_train can be a
+    SpectrumStore or SpectrumView), so the full matrix is never in memory.
+    One pass fits the scaler, then every epoch is a pass of SGD on the scaled
+    batches. Classes are balanced with sample weights, since the batches
+    cannot be oversampled.
+    """
+
+    def __init__(self, epochs=10, batch_size=256, alpha=1e-4):
+        self.epochs = epochs
+        self.batch_size = batch_size
+        self.alpha = alpha
+        self.model = None
+
+    def fit(self, x_train, y_train):
+        y_train = np.asarray(y_train)
+        classes = np.unique(y_train)
+        weights = compute_class_weight("balanced", classes=classes, y=y_train)
+
+        # Centering would densify sparse peak matrices
+        scaler = StandardScaler(with_mean=not issparse(x_train))
+        for x in BatchIterator(x_train, batch_size=self.batch_size):
+            scaler.partial_fit(x)
+
+        sgd = SGDClassifier(loss="log_loss", alpha=self.alpha, random_state=0)
+        batches = BatchIterator(
+            x_train,
+            batch_size=self.batch_size,
+            shuffle=True,
+            labels=y_train,
+            random_state=0,
+        )
+        print("Training with partial_fit...")
+        for epoch in range(self.epochs):
+            for x, y in batches:
+                sgd.partial_fit(
+                    scaler.transform(x),
+                    y,
+                    classes=classes,
+                    sample_weight=weights[np.searchsorted(classes, y)],
+                )
+        self.model = Pipeline([("scaler", scaler), ("sgd", sgd)])
+        return self.model
+
+    def save(self, path):
+        model = {"model": self.model}
+        with open(path, "wb") as handle:
+            pickle.dump(model, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, path):
+        with open(path, "rb") as handle:
+            model = pickle.load(handle)
+        self.model = model["model"]
+        return self.model
+
+    def predict(self, x_test):
+        return predict_in_batches(self.model, x_test, self.batch_size)[0]
+
+    def predict_proba(self, x_test):
+        return predict_in_batches(self.model, x_test, self.batch_size)[1]
+
+    def get_model(self):
+        return self.model
+
+
+def fit_one_vs_rest(x_train, y_train, x_test, y_test, maxit, pruning):
+    """Fit one binary DBL_class.LR_ARD, returns it with its pruned weights."""
+    model = DBL_class.LR_ARD()
+    model.fit(x_train, y_train, x_test, y_test, prune=0, maxit=maxit)
+    pesos = model.return_w()[:-1, :].ravel()
+    maximo = np.max(np.abs(pesos))
+    return model, np.where(np.abs(pesos) < maximo * pruning, 0.0, pesos)
+
+
 class LR_ARD(object):
-    def __init__(self):
-        pass
+    def __init__(self, multi_output=True, n_jobs=-1):
+        # With multi_output the three classes are the outputs of a single
+        # DBL_class.MultiLR_ARD, which computes the kernel products once.
+        # Otherwise the three one-vs-rest models are trained in parallel
+        # processes, n_jobs as in joblib
+        self.multi_output = multi_output
+        self.n_jobs = n_jobs
 
     def fit(self, z, y, z_tst = None, y_tst = None,  hyper = None, maxit = 30, 
             pruning = 8e-2):
@@ -301,44 +476,44 @@ class LR_ARD(object):
         x_train = np.hstack((self.z,ones_tr))
         x_test = np.hstack((self.z_tst,ones_test))
 
-        y_train_1 = np.where(self.t==0,1,0)
-        y_train_1 = np.reshape(y_train_1,(np.shape(y_train_1)[0],1))
-        y_train_2 = np.where(self.t==1,1,0)
-        y_train_2 = np.reshape(y_train_2,(np.shape(y_train_2)[0],1))
-        y_train_3 = np.where(self.t==2,1,0)
-        y_train_3 = np.reshape(y_train_3,(np.shape(y_train_3)[0],1))
-
-        y_tst_1 = np.where(self.t_tst==0,1,0)
-        y_tst_1 = np.reshape(y_tst_1,(np.shape(y_tst_1)[0],1))
-        y_tst_2 = np.where(self.t_tst==1,1,0)
-        y_tst_2 = np.reshape(y_tst_2,(np.shape(y_tst_2)[0],1))
-        y_tst_3 = np.where(self.t_tst==2,1,0)
-        y_tst_3 = np.reshape(y_tst_3,(np.shape(y_tst_3)[0],1))
-
         print('Training the models...')
 
-        self.myModel1 = DBL_class.LR_ARD()
-        self.myModel1.fit(x_train, y_train_1, x_test, y_tst_1,prune = 0,maxit = self.maxit)
-        pesos1 = self.myModel1.return_w()[:-1,:].ravel()
-        maximo1 = np.max(np.abs(pesos1))
-        self.pesos1 = np.where(np.abs(pesos1)<maximo1*self.pruning,0., pesos1)
-
-        self.myModel2 = DBL_class.LR_ARD()
-        self.myModel2.fit(x_train, y_train_2, x_test, y_tst_2,prune = 0, maxit = self.maxit)
-        pesos2 = self.myModel2.return_w()[:-1,:].ravel()
-        maximo2 = np.max(np.abs(pesos2))
-        self.pesos2 = np.where(np.abs(pesos2)<maximo2*self.pruning,0., pesos2)
-
-        self.myModel3 = DBL_class.LR_ARD()
-        self.myModel3.fit(x_train, y_train_3, x_test, y_tst_3,prune = 0, maxit = self.maxit)
-        pesos3 = self.myModel3.return_w()[:-1,:].ravel()
-        maximo3 = np.max(np.abs(pesos3))
-        self.pesos3 = np.where(np.abs(pesos3)<maximo3*self.pruning,0., pesos3)
+        if self.multi_output:
+            y_train = (np.reshape(self.t, (-1, 1)) == np.arange(3)).astype(int)
+            y_tst = (np.reshape(self.t_tst, (-1, 1)) == np.arange(3)).astype(int)
+            self.myModel = DBL_class.MultiLR_ARD()
+            self.myModel.fit(x_train, y_train, x_test, y_tst, prune=0, maxit=self.maxit)
+            pesos = self.myModel.return_w()[:-1, :]
+            maximo = np.max(np.abs(pesos), axis=0)
+            pesos = np.where(np.abs(pesos) < maximo * self.pruning, 0.0, pesos)
+            self.pesos1, self.pesos2, self.pesos3 = pesos.T
+            return
+
+        # One process per class, the cores are split between them so that
+        # their BLAS threads do not oversubscribe the machine
+        n_workers = min(3, effective_n_jobs(self.n_jobs))
+        blas_threads = max(1, cpu_count() // n_workers)
+        with parallel_backend("loky", inner_max_num_threads=blas_threads):
+            fitted = Parallel(n_jobs=n_workers)(
+                delayed(fit_one_vs_rest)(
+                    x_train,
+                    np.where(self.t == c, 1, 0).reshape(-1, 1),
+                    x_test,
+                    np.where(self.t_tst == c, 1, 0).reshape(-1, 1),
+                    self.maxit,
+                    self.pruning,
+                )
+                for c in range(3)
+            )
+        self.myModel1, self.pesos1 = fitted[0]
+        self.myModel2, self.pesos2 = fitted[1]
+        self.myModel3, self.pesos3 = fitted[2]
     
-    def predict_proba_true(self, Z_tst):
-        ones = np.ones((np.shape(Z_tst)[0],1))
-        Z_tst = np.hstack((Z_tst,ones))
-
+    def class_proba(self, Z_tst):
+        """Probabilities of the three one-vs-rest outputs (shape =
+        [n_samples, 3]), Z_tst with the bias column."""
+        if self.multi_output:
+            return self.myModel.predict_proba_th(Z_tst, pruning_crit=self.pruning)
         probs1 = self.myModel1.predict_proba_th(Z_tst,pruning_crit= self.pruning)
         probs2 = self.myModel2.predict_proba_th(Z_tst,pruning_crit= self.pruning)
         probs3 = self.myModel3.predict_proba_th(Z_tst,pruning_crit= self.pruning)
@@ -346,17 +521,18 @@ class LR_ARD(object):
         prob_p = np.hstack((probs1,probs2))
         probs = np.hstack((prob_p,probs3))
         return probs
+
+    def predict_proba_true(self, Z_tst):
+        ones = np.ones((np.shape(Z_tst)[0],1))
+        Z_tst = np.hstack((Z_tst,ones))
+
+        return self.class_proba(Z_tst)
     
     def predict_proba(self, Z_tst):
         #Ojo que esto es cutre cutre
 
         #Calculamos el minimo y maximo de la prob con las salidas de los datos de train
-        probs1 = self.myModel1.predict_proba_th(self.z,pruning_crit= self.pruning)
-        probs2 = self.myModel2.predict_proba_th(self.z,pruning_crit= self.pruning)
-        probs3 = self.myModel3.predict_proba_th(self.z,pruning_crit= self.pruning)
-
-        prob_p = np.hstack((probs1,probs2))
-        probs = np.hstack((prob_p,probs3))
+        probs = self.class_proba(self.z)
         #print(probs)
 
         maximo = np.max(probs.ravel())
@@ -367,12 +543,7 @@ class LR_ARD(object):
         ones = np.ones((np.shape(Z_tst)[0],1))
         Z_tst = np.hstack((Z_tst,ones))
 
-        probs1 = self.myModel1.predict_proba_th(Z_tst,pruning_crit= self.pruning)
-        probs2 = self.myModel2.predict_proba_th(Z_tst,pruning_crit= self.pruning)
-        probs3 = self.myModel3.predict_proba_th(Z_tst,pruning_crit= self.pruning)
-
-        prob_p = np.hstack((probs1,probs2))
-        probs = np.hstack((prob_p,probs3))
+        probs = self.class_proba(Z_tst)
         #Normalizamos las probabilidades de salida respecto a los datos de train
 
         probs_norm = self.normalize_data(probs, maximo, minimo)
@@ -0,0 +1,193 @@
+import pickle
+import numpy as np
+from spectrum_store import BatchIterator
+
+# Online outlier screening of spectra. Running statistics are updated one
+# spectrum at a time, so a new acquisition is scored in O(D) (D = number of
+# m/z bins, times the fixed number of components) without keeping the
+# dataset around.
+
+
+class RunningStats(object):
+    """Welford running mean and variance of vectors (or scalars)."""
+
+    def __init__(self, shape=()):
+        self.n = 0
+        self.mean = np.zeros(shape)
+        self.m2 = np.zeros(shape)
+
+    def update(self, x):
+        self.n += 1
+        delta = x - self.mean
+        self.mean += delta / self.n
+        self.m2 += delta * (x - self.mean)
+
+    @property
+    def var(self):
+        return self.m2 / max(self.n - 1, 1)
+
+    @property
+    def std(self):
+        return np.sqrt(self.var)
+
+    def scale(self, floor=1e-3):
+        """Standard deviation floored at floor times the data scale.
+
+        The data scale is the median of the positive standard deviations
+        (the median absolute mean when there is none, 1 when everything is
+        zero), so constant bins, e.g. empty m/z bins, give z-scores of the
+        order of the data instead of dividing by ~0.
+        """
+        std = np.atleast_1d(self.std)
+        reference = std[std > 0]
+        if reference.size == 0:
+            reference = np.abs(np.atleast_1d(self.mean))
+            reference = reference[reference > 0]
+        typical = np.median(reference) if reference.size else 1.0
+        return np.maximum(self.std, floor * typical)
+
+    def zscore(self, x, floor=1e-3):
+        return (x - self.mean) / self.scale(floor)
+
+
+class OutlierScreen(object):
+    """Incremental outlier screening of binned spectra.
+
+    Every spectrum is standardized with the Welford mean and variance of each
+    m/z bin and projected on a low-rank subspace learnt online with CCIPCA
+    (candid covariance-free incremental PCA). Two scores are tracked:
+
+    - the z-score of the mean intensity of the spectrum, the criterion of the
+      former batch script;
+    - the log energy of the residual out of the subspace, i.e. how much of
+      the spectrum the usual variation of the dataset does not explain.
+
+    A spectrum is flagged when any score is more than threshold standard
+    deviations away from its running mean. Flagged spectra do not update the
+    statistics, which keeps them robust to the outliers they detect.
+
+    Parameters
+    ----------
+    __n_components: int, (default 10).
+        Dimension of the PCA subspace.
+    __threshold: float, (default 3).
+        Number of standard deviations for a score to be flagged.
+    __min_samples: int, (default 30).
+        Spectra seen before flagging starts. Until then every spectrum
+        updates the statistics.
+    __amnesia: float, (default 2).
+        CCIPCA amnesic parameter, the larger the faster old spectra are
+        forgotten.
+    __std_floor: float, (default 1e-3).
+        Smallest standard deviation used to standardize a bin, as a fraction
+        of the median standard deviation of the bins (see RunningStats.scale).
+    """
+
+    def __init__(
+        self, n_components=10, threshold=3, min_samples=30, amnesia=2, std_floor=1e-3
+    ):
+        self.n_components = n_components
+        self.threshold = threshold
+        self.min_samples = min_samples
+        self.amnesia = amnesia
+        self.std_floor = std_floor
+        self.bins = None
+        self.components = None
+        self.mean_intensity = RunningStats()
+        self.residual = RunningStats()
+
+    def standardize(self, x):
+        # Screens pickled before std_floor existed use the default
+        return self.bins.zscore(x, getattr(self, "std_floor", 1e-3))
+
+    def residual_energy(self, z):
+        """Log of the mean squared residual of z out of the subspace."""
+        n_fitted = min(self.bins.n, self.n_components)
+        if n_fitted > 0:
+            basis = self.components[:n_fitted]
+            norms = np.linalg.norm(basis, axis=1)
+            basis = basis / np.maximum(norms, 1e-12)[:, np.newaxis]
+            z = z - (basis @ z) @ basis
+        return np.log(np.mean(z * z) + 1e-12)
+
+    def score(self, x):
+        """Scores of one spectrum, without updating the statistics.
+
+        Returns an array with the z-scores of the mean intensity and of the
+        residual energy.
+        """
+        x = np.asarray(x, dtype=np.float64).ravel()
+        z = self.standardize(x)
+        return np.array(
+            [
+                self.mean_intensity.zscore(np.mean(x)),
+                self.residual.zscore(self.residual_energy(z)),
+            ]
+        )
+
+    def is_outlier(self, x):
+        if self.bins is None or self.bins.n < self.min_samples:
+            return False
+        return bool(np.any(np.abs(self.score(x)) > self.threshold))
+
+    def update(self, x):
+        """Learn from one spectrum: Welford and CCIPCA updates."""
+        x = np.asarray(x, dtype=np.float64).ravel()
+        if self.bins is None:
+            self.bins = RunningStats(x.shape)
+            self.components = np.zeros((self.n_components, x.shape[0]))
+        self.bins.update(x)
+        z = self.standardize(x)
+        self.mean_intensity.update(np.mean(x))
+        self.residual.update(self.residual_energy(z))
+
+        n = self.bins.n
+        for i in range(min(n, self.n_components)):
+            if i == n - 1:
+                # A new component starts at the current residual
+                self.components[i] = z
+                break
+            v = self.components[i]
+            norm = np.linalg.norm(v) + 1e-12
+            l = min(self.amnesia, n - 1)
+            v *= (n - 1 - l) / n
+            v += (1 + l) / n * (z @ v) / norm * z
+            unit = v / (np.linalg.norm(v) + 1e-12)
+            z = z - (z @ unit) * unit
+
+    def partial_fit(self, X):
+        """Screen a batch of spectra in order and learn from the accepted ones.
+
+        Returns an array of bool (shape = [n_samples,]), True for the
+        spectra flagged as outliers.
+        """
+        X = np.atleast_2d(X)
+        flags = np.zeros(X.shape[0], bool)
+        for i, x in enumerate(X):
+            flags[i] = self.is_outlier(x)
+            if not flags[i]:
+                self.update(x)
+        return flags
+
+    def fit(self, data, batch_size=256):
+        """partial_fit over a whole dataset (store, view or array), streamed."""
+        flags = [np.zeros(0, bool)]
+        for X in BatchIterator(data, batch_size=batch_size):
+            flags.append(self.partial_fit(X))
+        return np.concatenate(flags)
+
+    def screen(self, data, batch_size=256):
+        """Flag the outliers of data with the current statistics (no update)."""
+        flags = [np.zeros(0, bool)]
+        for X in BatchIterator(data, batch_size=batch_size):
+            flags.append(np.array([self.is_outlier(x) for x in X], bool))
+        return np.concatenate(flags)
+
+    def save(self, path):
+        with open(path, "wb") as handle:
+            pickle.dump(self, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_screen(path):
+    with open(path, "rb") as handle:
+        return pickle.load(handle)
@@ -1,9 +1,10 @@
 import numpy as np
 import matplotlib.pyplot as plt
-from sklearn.mixture import GaussianMixture
 import yaml
 import pickle
-import scipy.stats as stats
+from spectrum_store import load_store
+from maldi_preprocess import check_grid
+from outlier_screen import OutlierScreen
 
 config = "config.yaml"
 
@@ -15,54 +16,58 @@ with open(
     config = yaml.load(file, Loader=yaml.FullLoader)
 
 main_path = config["main_path"]
-maldi_path = main_path + "data/data_final.pkl"
+maldi_path = main_path + "data/final"
 results = main_path + "results_paper/"
 
 # ============ Load data ===================
 print("Loading data...")
-with open(maldi_path, "rb") as handle:
-    data = pickle.load(handle)
-
-x = data["intensities"] * 1e4
-ids = data["ids"].squeeze()
-masses = data["masses"]
-y = data["labels"]
-
-mean_signals = np.mean(x, axis=1)
-# Detect outliers in X using the z-score
-z = np.abs(stats.zscore(mean_signals))
-threshold = 2.5
-outliers = np.where(z > threshold)
-print("Outliers detected: ", len(outliers[0]))
+data = load_store(maldi_path)
+check_grid(data.mz, name=maldi_path)
+
+ids = data.ids
+masses = data.mz
+y = data.labels
+
+# Learn the running statistics streaming the store once, then score every
+# spectrum against them
+screen = OutlierScreen()
+screen.fit(data)
+outliers = np.flatnonzero(screen.screen(data))
+print("Outliers detected: ", len(outliers))
 # Print ids of outliers
 print("Ids of outliers: ", ids[outliers])
 
+# predict.py flags new acquisitions with this screen before predicting, after
+# checking they are on the same grid
+screen.mz = masses
+screen.save(results + "final_model/outlier_screen.pkl")
+
 # Plot possible outliers given by the doctors
 possible_outliers = [18173872, 20413731]
 # SElect the possible outliers
-sample1 = x[ids == possible_outliers[0]]
-sample2 = x[ids == possible_outliers[1]]
-
-plt.plot(np.mean(masses, axis=0), np.mean(x, axis=0) / 1e4, label="Mean of all sapmles")
-plt.plot(
-    np.mean(masses, axis=0), np.mean(sample1, axis=0) / 1e4, label="Possible outlier"
-)
-plt.plot(
-    np.mean(masses, axis=0), np.mean(sample2, axis=0) / 1e4, label="Possible outlier"
-)
+sample1 = data.read(np.flatnonzero(ids == possible_outliers[0]))
+sample2 = data.read(np.flatnonzero(ids == possible_outliers[1]))
+mean_signal = screen.bins.mean
+
+plt.plot(masses, mean_signal / 1e4, label="Mean of all sapmles")
+plt.plot(masses, np.mean(sample1, axis=0) / 1e4, label="Possible outlier")
+plt.plot(masses, np.mean(sample2, axis=0) / 1e4, label="Possible outlier")
 plt.legend()
 
 
-# Plot possible outliers detected by z-score
+# Plot possible outliers detected by the screen
 # Select the possible outliers
-for outlier in outliers[0]:
+for outlier in outliers:
     plt.figure()
-    plt.plot(np.mean(masses, axis=0), np.mean(x, axis=0), label="Mean of all sapmles")
-    sample = x[outlier]
-    plt.plot(np.mean(masses, axis=0), sample, label="Possible outlier")
+    plt.plot(masses, mean_signal, label="Mean of all sapmles")
+    sample = data.read([outlier])[0]
+    plt.plot(masses, sample, label="Possible outlier")
     plt.legend()
 
 
+# # Existing data_final.pkl can be converted once with
+# # spectrum_store.pickle_to_store(main_path + "data/data_final.pkl", main_path + "data/final", scale=1e4)
+
 # # Genearte a pkl with all de data
 # paths = ["data/data_exp1.pkl", "data/data_exp3.pkl", "data/data_exp4_brote_gm.pkl", "data/data_exp4_brote_gomez_ulla.pkl"]
 
@@ -30,7 +30,11 @@ def plot_tree(model, x_train, y_train, masses_original, path, wandbflag=False):
 
 
 def plot_importances(model, importances, masses_original, path, wandbflag=False):
-    masses = np.mean(masses_original, axis=0)
+    # Binned datasets share one m/z grid, older ones have a masses matrix
+    if np.ndim(masses_original) == 1:
+        masses = np.asarray(masses_original)
+    else:
+        masses = np.mean(masses_original, axis=0)
     plt.figure(figsize=(10, 10))
     plt.plot(masses, importances)
     plt.xlabel("Feature importance")
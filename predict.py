@@ -1,40 +1,51 @@
 import argparse
-from sklearn.model_selection import train_test_split
 import yaml
 import pickle
 import numpy as np
 import os
 import pandas as pd
+from bruker_reader import read_bruker_tree
+from maldi_preprocess import preprocess_list, bin_spectra, check_grid
+from spectrum_store import predict_in_batches
+from export import export_table
+from outlier_screen import load_screen
 
+# Fitted by outliers.py on the training spectra
+SCREEN_PATH = "results_paper/final_model/outlier_screen.pkl"
 
-def preprocess_data(data_path, store_preprocess_data):
-    print("Preprocessing data with R script...")
-    os.system("Rscript preprocess_maldi.R " + data_path + " " + store_preprocess_data)
+
+def acquisition_id(fid_path, data_path):
+    """Id of an acquisition: the folders from data_path down to its fid,
+    joined with "_".
+
+    The first one is the sample folder, so ``id.split("_")[0]`` is still the
+    isolate id as with the CSV names of the R export, and the target/spot
+    folders keep several acquisitions of one sample apart.
+    """
+    folder = os.path.dirname(os.path.relpath(fid_path, data_path))
+    return "_".join(folder.split(os.sep))
+
+
+def preprocess_data(data_path):
+    print("Reading raw Bruker data...")
+    masses, intensities, metadata = read_bruker_tree(data_path)
+
+    print("Preprocessing data...")
+    intensities = preprocess_list(masses, intensities)
     print("Data preprocessed")
 
-    print("Loading data preprocessed (masses, intensities, sample_ids)")
-    masses = []
-    intensities = []
-    sample_ids = []
-    for folder in os.listdir(store_preprocess_data):
-        for file in os.listdir(store_preprocess_data + folder):
-            aux = np.loadtxt(
-                store_preprocess_data + folder + "/" + file, delimiter=",", skiprows=1
-            )
-
-            masses.append(aux[:18000, 0])
-            intensities.append(aux[:18000, 1])
-            # The sample id is the name of the csv file
-            sample_ids.append(file.split(".")[0])
-
-    # Convert to numpy array
-    masses = np.array(masses)
-    intensities = np.array(intensities) * 1e4
+    sample_ids = [acquisition_id(meta["file"], data_path) for meta in metadata]
+
+    # Resample onto the common m/z grid
+    masses, intensities = bin_spectra(masses, intensities)
+    intensities = np.multiply(intensities, 1e4, dtype=np.float32)
     print("Data loaded")
     return masses, intensities, sample_ids
 
 
-def predict(models, data_path, intensities, sample_ids):
+def predict(
+    models, data_path, intensities, sample_ids, outliers=None, batch_size=256, mz=None
+):
     columns = ["Sample"]
     for model_name in models:
         columns.append(model_name)
@@ -48,14 +59,22 @@ def predict(models, data_path, intensities, sample_ids):
         if not os.path.exists(path_to_results):
             os.makedirs(path_to_results)
 
-        with open(
-            "results_paper/final_model/" + model_name.lower() + "/model_all.pkl", "rb"
-        ) as handle:
+        model_path = "results_paper/final_model/" + model_name.lower()
+        with open(model_path + "/model_all.pkl", "rb") as handle:
             model = pickle.load(handle)
 
-        # Predict
-        y_pred = np.array(np.array(model.predict(intensities), dtype=int), dtype=str)
-        y_pred_proba = model.predict_proba(intensities)
+        # The features must be on the grid the model was trained on
+        if mz is not None:
+            if os.path.exists(model_path + "/mz.npy"):
+                check_grid(mz, np.load(model_path + "/mz.npy"), name="the spectra")
+            else:
+                print("Warning: no m/z grid saved with " + model_name + ", not checked")
+
+        # Predict, batch_size spectra at a time (intensities can be a store)
+        y_pred, y_pred_proba = predict_in_batches(
+            model, intensities, batch_size=batch_size
+        )
+        y_pred = np.array(np.array(y_pred, dtype=int), dtype=str)
 
         if model_name == "FAVAE":
             y_pred_proba = y_pred_proba / y_pred_proba.sum(axis=1)[:, None]
@@ -65,25 +84,37 @@ def predict(models, data_path, intensities, sample_ids):
         y_pred = np.where(y_pred == "1", "RT181", y_pred)
         y_pred = np.where(y_pred == "2", "Others", y_pred)
 
-        # Store in results dataframe a new row for each sample with the prediction of each model
-        for i in range(len(y_pred)):
-            results["Sample"][i] = sample_ids[i]
-            results[model_name][i] = y_pred[i]
-            results[model_name + " probability"][i] = np.max(y_pred_proba[i])
+        # Store in results dataframe the prediction of each model for every sample
+        results["Sample"] = sample_ids
+        results[model_name] = y_pred
+        results[model_name + " probability"] = np.max(y_pred_proba, axis=1)
 
-    print("Storing results in csv...")
+    if outliers is not None:
+        results["Outlier"] = outliers
 
-    # Store results dataframe in csv
-    results.to_csv(path_to_results + "results.csv", index=False)
+    print("Storing results in parquet and csv...")
+
+    # Store results dataframe in parquet, with the same table as csv for clinicians
+    export_table(
+        results,
+        path_to_results + "results.parquet",
+        csv_summary=path_to_results + "results.csv",
+    )
 
 
 def main(data_path, model_name):
-    # Preprocess data using R script
-    store_preprocess_data = data_path + "/results/data_processed/"
-    # Check if store_preprocess_data exists
-    if not os.path.exists(store_preprocess_data):
-        os.makedirs(store_preprocess_data)
-    masses, intensities, sample_ids = preprocess_data(data_path, store_preprocess_data)
+    # Read and preprocess the raw data in-process
+    masses, intensities, sample_ids = preprocess_data(data_path)
+
+    # Flag bad acquisitions before they are predicted
+    outliers = None
+    if os.path.exists(SCREEN_PATH):
+        screen = load_screen(SCREEN_PATH)
+        if getattr(screen, "mz", None) is not None:
+            check_grid(masses, screen.mz, name="the spectra")
+        outliers = screen.screen(intensities)
+        for sample_id in np.asarray(sample_ids)[outliers]:
+            print("Warning: possible outlier " + sample_id)
 
     # Define models to use
     if model_name is None:
@@ -92,10 +123,9 @@ def main(data_path, model_name):
         models = [model_name]
 
     # Predict
-    predict(models, data_path, intensities, sample_ids)
-
-    # Remove data preprocessed
-    os.system("rm -r " + store_preprocess_data)
+    predict(
+        models, data_path, intensities, sample_ids, outliers=outliers, mz=masses
+    )
 
 
 if __name__ == "__main__":
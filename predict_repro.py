@@ -5,6 +5,9 @@ import pickle
 import numpy as np
 import os
 import pandas as pd
+from maldi_preprocess import bin_spectra
+from ingestion import ingest
+from export import export_table
 
 
 def preprocess_data(data_path, store_preprocess_data):
@@ -20,14 +23,14 @@ def preprocess_data(data_path, store_preprocess_data):
                 store_preprocess_data + folder + "/" + file, delimiter=",", skiprows=1
             )
 
-            masses.append(aux[:18000, 0])
-            intensities.append(aux[:18000, 1])
+            masses.append(aux[:, 0])
+            intensities.append(aux[:, 1])
             # The sample id is the name of the csv file
             sample_ids.append(file.split(".")[0])
 
-    # Convert to numpy array
-    masses = np.array(masses)
-    intensities = np.array(intensities) * 1e4
+    # Resample onto the common m/z grid
+    masses, intensities = bin_spectra(masses, intensities)
+    intensities = np.multiply(intensities, 1e4, dtype=np.float32)
     print("Data loaded")
     return masses, intensities, sample_ids
 
@@ -76,15 +79,14 @@ def predict(
         labels = np.where(labels == "181", "RT181", labels)
         labels = np.where((labels != "RT027") & (labels != "RT181"), "Others", labels)
 
-        # Store in results dataframe a new row for each sample with the prediction of each model
-        for i in range(len(y_pred)):
-            results["Sample"][i] = sample_ids[i]
-            results[model_name][i] = y_pred[i]
-            results[model_name + " probability"][i] = np.max(y_pred_proba[i])
-            results["Medio"][i] = medios[i]
-            results["True_label"][i] = labels[i]
-            results["Semana"][i] = semanas[i]
-            results["Grupo"][i] = grupos[i]
+        # Store in results dataframe the prediction of each model for every sample
+        results["Sample"] = sample_ids
+        results[model_name] = y_pred
+        results[model_name + " probability"] = np.max(y_pred_proba, axis=1)
+        results["Medio"] = medios
+        results["True_label"] = labels
+        results["Semana"] = semanas
+        results["Grupo"] = grupos
 
     # Calculate accurary
     total_acc = (results["DBLFS"] == results["True_label"]).sum() / len(results)
@@ -137,10 +139,14 @@ def predict(
     print("Accuracy per semana: " + str(semana_acc))
     print("Accuracy per grupo: " + str(grupo_acc))
 
-    print("Storing results in csv...")
+    print("Storing results in parquet and csv...")
 
-    # Store results dataframe in csv
-    results.to_csv(path_to_results + "results.csv", index=False)
+    # Store results dataframe in parquet, with the same table as csv for clinicians
+    export_table(
+        results,
+        path_to_results + "results.parquet",
+        csv_summary=path_to_results + "results.csv",
+    )
 
 
 def read_repro(data_path):
@@ -153,41 +159,39 @@ def read_repro(data_path):
     semanas = []
     grupos = []
 
+    files = []
     for semana in os.listdir(data_path):
         for grupo in os.listdir(data_path + "/" + semana):
             for medio in os.listdir(data_path + "/" + semana + "/" + grupo):
                 for file in os.listdir(
                     data_path + "/" + semana + "/" + grupo + "/" + medio
                 ):
-                    aux = np.loadtxt(
-                        data_path
-                        + "/"
-                        + semana
-                        + "/"
-                        + grupo
-                        + "/"
-                        + medio
-                        + "/"
-                        + file,
-                        delimiter=",",
-                        skiprows=1,
+                    files.append(
+                        data_path + "/" + semana + "/" + grupo + "/" + medio + "/" + file
                     )
 
-                    masses.append(aux[:18000, 0])
-                    intensity = aux[:18000, 1]
-                    # Normalise intensity by Total Ion Current method (all intensity have to sum up to 1)
-                    intensity = intensity / np.sum(intensity)
-                    intensities.append(intensity)
-                    # The sample id is the name of the csv file
-                    sample_ids.append(file.split("_")[0])
-                    medios.append(medio.split(" ")[1])
-                    labels.append(file.split("_")[1])
-                    semanas.append(semana.split(" ")[0])
-                    grupos.append(grupo.split(" ")[1])
-
-    # Convert to numpy array
-    masses = np.array(masses)
-    intensities = np.array(intensities) * 1e4
+    # Parse all the csv in parallel, files that fail are skipped
+    spectra, failed = ingest(files)
+
+    for path, spectrum in zip(files, spectra):
+        if spectrum is None:
+            continue
+        semana, grupo, medio, file = path[len(data_path) + 1 :].split("/")
+        masses.append(spectrum[0])
+        intensities.append(spectrum[1])
+        # The sample id is the name of the csv file
+        sample_ids.append(file.split("_")[0])
+        medios.append(medio.split(" ")[1])
+        labels.append(file.split("_")[1])
+        semanas.append(semana.split(" ")[0])
+        grupos.append(grupo.split(" ")[1])
+
+    # Resample onto the common m/z grid
+    masses, intensities = bin_spectra(masses, intensities)
+    # Normalise intensity by Total Ion Current method (all intensity have to sum up to 1)
+    intensities = np.multiply(
+        intensities, 1e4 / np.sum(intensities, axis=1)[:, None], dtype=np.float32
+    )
     print("Data loaded")
     return masses, intensities, sample_ids, labels, medios, semanas, grupos
 
@@ -1,6 +1,11 @@
 import pandas as pd
 import os
 import numpy as np
+from spectrum_store import write_split, SpectrumView
+from ingestion import ingest_incremental
+from label_service import load_label_table, resolve_labels
+from maldi_preprocess import replicate_groups
+from export import export_spectra
 
 # Read data from path
 pathinitial = "data/maldi_processed/initial"
@@ -26,63 +31,67 @@ for (dirpath, dirnames, filenames) in os.walk(pathsecond):
             label_list.append(np.nan)
 
 
-# Read todas_labels.xlsx
-pathlabels = "data/todas_labels.xlsx"
-df_labels = pd.read_excel(pathlabels, header=None)
-
-
-# For all the nans in label_list, look they id in the df_labels to retrieve real label
-for i in range(len(label_list)):
-    if label_list[i] is np.nan:
-       # Check if exists in df_labels
-        if int(id_list[i]) in df_labels[1].values: 
-            label_list[i] = df_labels[df_labels[1] == int(id_list[i])][2].values[0]
-        else:
-            print("Error: id not found in df_labels")
+# For all the nans in label_list, look they id in todas_labels.xlsx to retrieve
+# real label, all of them in one join against the cached labels table
+unlabelled = [i for i in range(len(label_list)) if label_list[i] is np.nan]
+ribotypes, missing = resolve_labels(
+    load_label_table(), [int(id_list[i]) for i in unlabelled]
+)
+for i, ribotype in zip(unlabelled, ribotypes):
+    if ribotype is not None:
+        label_list[i] = ribotype
 
 # check if there is any nan in label_list
 if np.nan in label_list:
     print("Error: there is nan in label_list")
 
+columns = ["id", "label", "intensity"]
 
-import pandas as pd
-
-columns = ["id", "label", "mz", "intensity"]
-data_list = []
-
-for i, file in enumerate(listOfFiles):
-    print("Loading bar: ", i + 1, "/", len(listOfFiles))
-    df_temp = pd.read_csv(file, header=None)
-    id = id_list[i]
-    label = label_list[i]
-    mz = np.array(df_temp[0][1:].values).astype(float)
-    intensity = np.array(df_temp[1][1:].values).astype(float)
+# Bring the binned exp2 store up to date, only new or changed csv are parsed
+sources = {
+    file: {"id": id_list[i], "label": label_list[i], "experiment": "exp2"}
+    for i, file in enumerate(listOfFiles)
+}
+store = ingest_incremental(
+    "data/exp2_all", listOfFiles, sources.get, screen_outliers=True
+)
+mz = store.mz
 
-    data_list.append({"id": id, "label": label, "mz": mz, "intensity": intensity})
-
-df_final = pd.DataFrame(data_list, columns=columns)
+df_final = store.metadata[["id", "label"]].copy()
 
 # Let split the df_final in train and test.
-# To do so, group by labels and then sample 80% of each label for train and 20% for test
-df_train = pd.DataFrame(columns=columns)
-df_test = pd.DataFrame(columns=columns)
-
-for label in df_final["label"].unique():
-    # ESTO NO ESTÁ BIEN, PORQUE HAY REPLICAS. HAY QUE HACERLO POR ID+LABEL PARA ASEGURARME QUE NO ESTÁ EL MISMO ID EN TRAIN Y TEST
-    # PARA ESO HAY QUE TENER EN CUENTA QUE CUANDO HAUA SOLO UNA MUESTRA POR ID, ESTÁ VA EN ENTRENAMIENTO Y NO EN TEST
-    # PONER UN IF PA ESO
-    df_temp = df_final[df_final["label"] == label]
-    df_temp_train = df_temp.sample(frac=0.8, random_state=42)
-    df_temp_test = df_temp.drop(df_temp_train.index)
-    df_train = pd.concat([df_train, df_temp_train])
-    df_test = pd.concat([df_test, df_temp_test])
-
-# save df_train and df_test
-df_train.to_pickle("data/df_train_exp2.pkl")
-df_test.to_pickle("data/df_test_exp2.pkl")
-
-# save them too as csv
-df_train.to_csv("data/df_train_exp2.csv", index=False)
-df_test.to_csv("data/df_test_exp2.csv", index=False)
+# To do so, group by labels and then sample 80% of the ids of each label for train
+# and 20% for test. Sampling ids instead of rows keeps all the replicates of an
+# isolate on the same side; a label with a single id goes to train.
+unique_ids, first, groups = replicate_groups(df_final["id"].values)
+id_labels = df_final["label"].values[first]
+train_ids = []
+for label in pd.unique(id_labels):
+    label_ids = pd.Series(unique_ids[id_labels == label])
+    train_ids += label_ids.sample(frac=0.8, random_state=42).tolist()
+
+is_train = df_final["id"].isin(train_ids)
+df_train = df_final[is_train]
+df_test = df_final[~is_train]
+assert len(set(df_train["id"]) & set(df_test["id"])) == 0
+
+# save df_train and df_test as row indices over the shared exp2 store
+write_split(
+    "data/exp2_all",
+    "exp2",
+    {"train": df_train.index.values, "test": df_test.index.values},
+)
+
+# export them too as parquet, with a csv summary of the samples
+export_spectra(
+    SpectrumView(store, df_train.index.values),
+    "data/df_train_exp2.parquet",
+    csv_summary="data/df_train_exp2.csv",
+)
+export_spectra(
+    SpectrumView(store, df_test.index.values),
+    "data/df_test_exp2.parquet",
+    csv_summary="data/df_test_exp2.csv",
+)
 
 
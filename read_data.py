@@ -1,8 +1,9 @@
-import pandas as pd
 import os
-import pickle
 import numpy as np
-from sklearn.model_selection import train_test_split
+from spectrum_store import write_split, load_store, SpectrumView
+from ingestion import ingest_incremental
+from label_service import load_label_table, resolve_labels
+from export import export_spectra
 
 
 def read_data(path, rawpath, data="train"):
@@ -35,47 +36,39 @@ def read_data(path, rawpath, data="train"):
         set(["/".join(file.split("/")[:12]) for file in listOfFilesraw])
     )
 
-    # Read labels from todas_labels.xlsx
-    labels = pd.read_excel("data/todas_labels.xlsx", header=None)
-    ids = [int(file.split("/")[-1].split("_")[0]) for file in listOfFiles]
+    if data == "train":
+        experiment, store_path = "exp1", "data/exp1_all"
+    elif data == "test":
+        experiment, store_path = "exp3", "data/exp3"
 
-    # Read each csv of listOfFiles and append it to df to the MALDI column
     if data == "test":
-        data = []
-        for file in listOfFiles:
-            d = pd.read_csv(file)
-            id = int(file.split("/")[-1].split("_")[0])
-            data.append(
-                [
-                    id,
-                    d["mass"].values[:18000],
-                    d["intensity"].values[:18000],
-                    str(labels[labels[1] == id][2].values[0]),
-                ]
-            )
-        df = pd.DataFrame(data, columns=["id", "MALDI_mass", "MALDI_int", "label"])
+        # Resolve the labels of all files at once from todas_labels.xlsx
+        ids = [int(file.split("/")[-1].split("_")[0]) for file in listOfFiles]
+        file_labels, missing = resolve_labels(load_label_table(), ids)
+        # Files without a label cannot be used
+        listOfFiles = [
+            file for file, label in zip(listOfFiles, file_labels) if label is not None
+        ]
+        ids = [id for id, label in zip(ids, file_labels) if label is not None]
+        file_labels = [label for label in file_labels if label is not None]
     elif data == "train":
-        data = []
-        for file in listOfFiles:
-            d = pd.read_csv(file)
-            id = int(file.split("/")[-2].split("-")[1])
-            label = file.split("/")[-2].split("-")[0]
-            data.append(
-                [
-                    id,
-                    d["mass"].values[:18000],
-                    d["intensity"].values[:18000],
-                    str(label),
-                ]
-            )
-        df = pd.DataFrame(data, columns=["id", "MALDI_mass", "MALDI_int", "label"])
+        ids = [int(file.split("/")[-2].split("-")[1]) for file in listOfFiles]
+        file_labels = [file.split("/")[-2].split("-")[0] for file in listOfFiles]
+
+    sources = {}
+    for file, id, label in zip(listOfFiles, ids, file_labels):
+        # Substitute the label with the number of the class: '027' -> 0, '181' -> 1, rest -> 2
+        label = {"027": 0, "181": 1}.get(str(label), 2)
+        sources[file] = {"id": id, "label": label, "experiment": experiment}
+
+    # Bring the binned store up to date, only new or changed csv are parsed
+    store = ingest_incremental(
+        store_path, listOfFiles, sources.get, scale=1e4, screen_outliers=True
+    )
+    mz = store.mz
 
-    # Substitute the label with the number of the class: '027' -> 0, '181' -> 1, rest -> 2
-    df["label"] = df["label"].replace({"027": 0, "181": 1})
-    # All other labels are 2
-    for index in df["label"].value_counts().index:
-        if index != 0 and index != 1:
-            df["label"] = df["label"].replace({index: 2})
+    # One row per spectrum, the spectra themselves stay in the store
+    df = store.metadata[["id", "label"]].copy()
 
     # Split train and test by "id" column
     if data == "train":
@@ -84,51 +77,36 @@ def read_data(path, rawpath, data="train"):
         df_test = df[df["id"].isin(ids_to_split[int(len(ids_to_split) * 0.7) :])]
         # check that the any id in train is not in test
         assert len(set(df_train["id"].unique()) & set(df_test["id"].unique())) == 0
-        # Store them as xlsx
-        df_train.to_excel("data/train_exp1.xlsx", index=False)
-        df_test.to_excel("data/val_exp1.xlsx", index=False)
-        # Train dictionary
-        train = {
-            "ids": df_train["id"].values,
-            "masses": df_train["MALDI_mass"].values,
-            "intensities": df_train["MALDI_int"].values,
-            "labels": df_train["label"].values,
-        }
-        # Test dictionary
-        test = {
-            "ids": df_test["id"].values,
-            "masses": df_test["MALDI_mass"].values,
-            "intensities": df_test["MALDI_int"].values,
-            "labels": df_test["label"].values,
-        }
-        data = {"train": train, "test": test}
-        with open("data/data_exp1.pkl", "wb") as handle:
-            pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
-
-        # Given the ids in train and test, create two different folders with the raw data splitted
+        # Export them as parquet, with a csv summary of the samples
+        export_spectra(
+            SpectrumView(store, df_train.index.values),
+            "data/train_exp1.parquet",
+            csv_summary="data/train_exp1.csv",
+        )
+        export_spectra(
+            SpectrumView(store, df_test.index.values),
+            "data/val_exp1.parquet",
+            csv_summary="data/val_exp1.csv",
+        )
+        # Given the ids in train and test, list the raw data folders of each partition
+        raw = {"train": [], "val": []}
         for file in listOfFilesraw:
             id = int(file.split("/")[-1].split("-")[1])
             if id in df_train["id"].values:
-                os.system(f"cp -R {file} data/exp1/rain")
+                raw["train"].append(file)
             elif id in df_test["id"].values:
-                os.system(f"cp -R {file} data/exp1/val")
-
-    elif data == "test":
-        # Store it as xlsx valled test exp3
-        df.to_excel("data/test_exp3.xlsx", index=False)
-        # Test dictionary
-        test = {
-            "ids": df["id"].values,
-            "masses": df["MALDI_mass"].values,
-            "intensities": df["MALDI_int"].values,
-            "labels": df["label"].values,
-        }
-        data = {"test": test}
-        with open("data/data_exp3.pkl", "wb") as handle:
-            pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
+                raw["val"].append(file)
 
-        # Read data from the pkl
-        with open("data/data_exp3.pkl", "rb") as handle:
-            data = pickle.load(handle)
+        # Store the split as row indices over the shared exp1 store
+        write_split(
+            store_path,
+            "exp1",
+            {"train": df_train.index.values, "val": df_test.index.values},
+            raw=raw,
+        )
 
-        
+    elif data == "test":
+        # Export it as parquet called test exp3
+        export_spectra(store, "data/test_exp3.parquet", csv_summary="data/test_exp3.csv")
+        # The exp3 store is already up to date, open it memory-mapped
+        data = load_store("data/exp3")
@@ -0,0 +1,469 @@
+import os
+import json
+import math
+import time
+import hashlib
+import tempfile
+import numpy as np
+from scipy import sparse
+from joblib import Parallel, delayed
+from imblearn.over_sampling import RandomOverSampler
+from sklearn.base import clone
+from sklearn.utils.class_weight import compute_sample_weight
+from sklearn.metrics import get_scorer
+from sklearn.model_selection import (
+    GridSearchCV,
+    ParameterGrid,
+    StratifiedKFold,
+    check_cv,
+)
+
+# Hyperparameter search backends for the model wrappers. "grid" is the plain
+# GridSearchCV; "halving" is successive halving: every candidate is first
+# cross-validated with a small budget (few samples or few trees), only the
+# best 1/factor go on to the next round with factor times more budget.
+#
+# The training matrix is published once as a memory-mapped file (in shared
+# memory when /dev/shm exists) and the workers only receive row indices:
+# joblib sends a memmap by file name instead of pickling its content.
+
+SHARED_FOLDER = "/dev/shm" if os.path.isdir("/dev/shm") else tempfile.gettempdir()
+
+# Rows copied at a time when a matrix is published
+CHUNK_ROWS = 1024
+
+# Files created by shared_matrix, the only ones release_matrix deletes
+PUBLISHED = set()
+
+
+def shared_matrix(X, rows=None):
+    """Memory-mapped, read-only copy of X[rows] that workers can share.
+
+    A memmap is returned as is when no rows are selected (e.g. the
+    intensities of a SpectrumStore). Rows are copied in chunks, so the
+    selection is never materialized in memory. Sparse matrices are
+    returned (sliced) unchanged.
+    """
+    if sparse.issparse(X):
+        return X if rows is None else X[rows]
+    if rows is None:
+        if isinstance(X, np.memmap):
+            return X
+        rows = np.arange(X.shape[0])
+    handle, filename = tempfile.mkstemp(suffix=".npy", dir=SHARED_FOLDER)
+    os.close(handle)
+    PUBLISHED.add(os.path.abspath(filename))
+    out = np.lib.format.open_memmap(
+        filename, mode="w+", dtype=X.dtype, shape=(len(rows),) + X.shape[1:]
+    )
+    for start in range(0, len(rows), CHUNK_ROWS):
+        out[start : start + CHUNK_ROWS] = X[rows[start : start + CHUNK_ROWS]]
+    out.flush()
+    del out
+    return np.load(filename, mmap_mode="r")
+
+
+def release_matrix(X):
+    """Delete the file of a matrix published by shared_matrix.
+
+    Any other memmap (e.g. the intensities of a store, passed through by
+    shared_matrix) is left alone.
+    """
+    if isinstance(X, np.memmap) and X.filename is not None:
+        filename = os.path.abspath(X.filename)
+        if filename in PUBLISHED:
+            os.remove(filename)
+            PUBLISHED.discard(filename)
+
+
+def balancing(y, balance="weights"):
+    """Rows and weighting of a class-balanced training set.
+
+    "weights" keeps the rows as they are and balances the classes with
+    sample weights (returns rows=None, balanced=True); "oversample"
+    repeats minority rows as RandomOverSampler does (returns the
+    oversampled rows, balanced=False).
+    """
+    if balance == "weights":
+        return None, True
+    elif balance == "oversample":
+        return oversample_rows(y), False
+    raise ValueError("Balancing mode not implemented")
+
+
+def oversample_rows(y, random_state=None):
+    """RandomOverSampler as row indices: the rows of the balanced training
+    set, minority rows repeated, without copying any spectrum."""
+    y = np.asarray(y)
+    ros = RandomOverSampler(random_state=random_state)
+    rows, y_rows = ros.fit_resample(np.arange(len(y))[:, np.newaxis], y)
+    return rows.ravel()
+
+
+def cached_folds(y, n_splits=5, cache=None):
+    """StratifiedKFold folds of y, the GridSearchCV default (unshuffled)
+    layout.
+
+    With a cache (a dict owned by one search, dropped with it) the folds are
+    computed once per set of labels.
+    """
+    classes, codes = np.unique(np.asarray(y), return_inverse=True)
+    key = (hashlib.sha1(codes.astype(np.int64).tobytes()).hexdigest(), n_splits)
+    if cache is not None and key in cache:
+        return cache[key]
+    folds = list(StratifiedKFold(n_splits=n_splits).split(codes, codes))
+    if cache is not None:
+        cache[key] = folds
+    return folds
+
+
+def fit_balanced(estimator, X, y, balanced=False):
+    """estimator.fit, with "balanced" sample weights computed on y if asked."""
+    if balanced:
+        return estimator.fit(X, y, sample_weight=compute_sample_weight("balanced", y))
+    return estimator.fit(X, y)
+
+
+def fit_and_score(estimator, params, X, y, train, test, scorer, balanced=False):
+    estimator = clone(estimator).set_params(**params)
+    fit_balanced(estimator, X[train], y[train], balanced)
+    return scorer(estimator, X[test], y[test])
+
+
+def stratified_subsample(y, n_samples, rng):
+    """Row indices of a class-stratified random subset of n_samples rows."""
+    if n_samples >= len(y):
+        return np.arange(len(y))
+    classes, y_idx = np.unique(y, return_inverse=True)
+    counts = np.bincount(y_idx)
+    # At least one row per class and as many as possible in proportion
+    n_class = np.maximum(np.floor(counts * n_samples / len(y)).astype(int), 1)
+    rows = [
+        rng.choice(np.flatnonzero(y_idx == c), min(n, counts[c]), replace=False)
+        for c, n in enumerate(n_class)
+    ]
+    return np.sort(np.concatenate(rows))
+
+
+class HalvingSearch(object):
+    """Successive halving search over a parameter grid.
+
+    Follows the GridSearchCV interface: fit(X, y), then best_estimator_,
+    best_params_, best_score_ and cv_results_.
+
+    Parameters
+    ----------
+    __estimator: sklearn estimator.
+        Base estimator, cloned for every fit.
+    __param_grid: dict or list of dicts.
+        As in GridSearchCV.
+    __scoring: str, (default "balanced_accuracy").
+    __cv: int, (default 5).
+        Number of stratified folds.
+    __factor: int, (default 3).
+        Only the best 1/factor candidates survive each round, and the next
+        round has factor times more budget.
+    __resource: str, (default "n_samples").
+        What the budget is: "n_samples" (training rows) or the name of an
+        estimator parameter such as "n_estimators".
+    __min_resources, __max_resources: int, (default None).
+        Budget of the first and of the last round. By default the last
+        round uses all samples (or max_resources) and the first one is
+        scaled down so that the rounds end with one candidate.
+    __time_budget: float, (default None).
+        Seconds. No new round is started once the budget is spent; the best
+        candidate of the last finished round wins.
+    __skip: function, (default None).
+        skip(params) is True for invalid combinations, which are dropped
+        before anything is dispatched.
+    __n_jobs, __verbose, __random_state:
+        As in GridSearchCV.
+    """
+
+    def __init__(
+        self,
+        estimator,
+        param_grid,
+        scoring="balanced_accuracy",
+        cv=5,
+        factor=3,
+        resource="n_samples",
+        min_resources=None,
+        max_resources=None,
+        time_budget=None,
+        skip=None,
+        n_jobs=-1,
+        verbose=1,
+        random_state=0,
+    ):
+        self.estimator = estimator
+        self.param_grid = param_grid
+        self.scoring = scoring
+        self.cv = cv
+        self.factor = factor
+        self.resource = resource
+        self.min_resources = min_resources
+        self.max_resources = max_resources
+        self.time_budget = time_budget
+        self.skip = skip
+        self.n_jobs = n_jobs
+        self.verbose = verbose
+        self.random_state = random_state
+
+    def resources(self, n_candidates, n_samples, n_classes):
+        """Budget of every round."""
+        n_rounds = 1 + int(math.ceil(math.log(max(n_candidates, 1), self.factor)))
+        if self.resource == "n_samples":
+            max_resources = self.max_resources or n_samples
+            smallest = 2 * self.cv * n_classes
+        else:
+            max_resources = self.max_resources or self.estimator.get_params()[
+                self.resource
+            ]
+            smallest = self.factor
+        if self.min_resources is not None:
+            return [
+                min(self.min_resources * self.factor**i, max_resources)
+                for i in range(n_rounds)
+            ]
+        # Count back from the last round, which gets the whole budget
+        return [
+            max(smallest, max_resources // self.factor ** (n_rounds - 1 - i))
+            for i in range(n_rounds)
+        ]
+
+    def fit(self, X, y, rows=None, balanced=False):
+        """Search on X[rows], y[rows] (all rows if None).
+
+        rows may repeat rows (oversampling); X is only indexed by the
+        workers, so it should be a memmap (see shared_matrix). With
+        balanced, every fit gets "balanced" sample weights computed on its
+        own training fold.
+        """
+        y = np.asarray(y)
+        if rows is None:
+            rows = np.arange(len(y))
+        rows = np.asarray(rows)
+        start = time.time()
+        rng = np.random.RandomState(self.random_state)
+        scorer = get_scorer(self.scoring)
+        candidates = [
+            params
+            for params in ParameterGrid(self.param_grid)
+            if self.skip is None or not self.skip(params)
+        ]
+        budgets = self.resources(len(candidates), len(rows), len(np.unique(y[rows])))
+        self.cv_results_ = []
+        # Rounds on the same rows (resource other than n_samples) share folds
+        fold_cache = {}
+
+        best = candidates
+        for i, budget in enumerate(budgets):
+            if self.time_budget is not None and time.time() - start > self.time_budget:
+                print("Time budget spent, stopping after round", i)
+                break
+            if self.resource == "n_samples":
+                subset = rows[stratified_subsample(y[rows], budget, rng)]
+                params = candidates
+            else:
+                subset = rows
+                params = [dict(c, **{self.resource: budget}) for c in candidates]
+            folds = cached_folds(y[subset], self.cv, fold_cache)
+            if self.verbose:
+                print(
+                    "Round",
+                    i,
+                    ":",
+                    len(candidates),
+                    "candidates,",
+                    self.resource,
+                    "=",
+                    budget,
+                )
+            scores = Parallel(n_jobs=self.n_jobs)(
+                delayed(fit_and_score)(
+                    self.estimator,
+                    p,
+                    X,
+                    y,
+                    subset[train],
+                    subset[test],
+                    scorer,
+                    balanced,
+                )
+                for p in params
+                for train, test in folds
+            )
+            scores = np.reshape(scores, (len(candidates), len(folds))).mean(axis=1)
+            for p, score in zip(params, scores):
+                self.cv_results_.append(
+                    {"params": p, "round": i, "mean_test_score": score}
+                )
+
+            order = np.argsort(-scores, kind="stable")
+            best = [candidates[k] for k in order]
+            self.best_score_ = scores[order[0]]
+            if len(candidates) == 1:
+                break
+            candidates = best[: max(1, int(math.ceil(len(candidates) / self.factor)))]
+
+        self.best_params_ = best[0]
+        if self.resource != "n_samples":
+            self.best_params_ = dict(self.best_params_, **{self.resource: budgets[-1]})
+        self.best_estimator_ = clone(self.estimator).set_params(**self.best_params_)
+        fit_balanced(self.best_estimator_, X[rows], y[rows], balanced)
+        return self
+
+
+def make_search(
+    estimator,
+    param_grid,
+    search="halving",
+    scoring="balanced_accuracy",
+    cv=5,
+    verbose=2,
+    n_jobs=-1,
+    **kwargs
+):
+    """Search backend of the model wrappers: "halving" or "grid".
+
+    Extra keyword arguments (resource, time_budget, skip, ...) go to
+    HalvingSearch. With "grid", skip is applied by expanding the grid and
+    dropping the invalid candidates.
+    """
+    if search == "halving":
+        return HalvingSearch(
+            estimator,
+            param_grid,
+            scoring=scoring,
+            cv=cv,
+            verbose=verbose,
+            n_jobs=n_jobs,
+            **kwargs
+        )
+    elif search == "grid":
+        skip = kwargs.get("skip")
+        if skip is not None:
+            param_grid = [
+                {key: [value] for key, value in params.items()}
+                for params in ParameterGrid(param_grid)
+                if not skip(params)
+            ]
+        return GridSearchCV(
+            estimator=estimator,
+            param_grid=param_grid,
+            scoring=scoring,
+            cv=cv,
+            verbose=verbose,
+            n_jobs=n_jobs,
+        )
+    raise ValueError("Search backend not implemented")
+
+
+def run_search(search, X, y, rows=None, balanced=False):
+    """Fit a search on X[rows], y[rows], publishing X once for the workers.
+
+    Both backends receive the shared matrix and only index it: HalvingSearch
+    takes the rows directly; GridSearchCV gets its folds (its own cv,
+    computed on y[rows]) as arrays of rows of X, and the best candidate is
+    refitted on X[rows] afterwards. balanced threads "balanced" sample
+    weights through the search (see balancing).
+    """
+    y = np.asarray(y)
+    X = shared_matrix(X)
+    if isinstance(search, HalvingSearch):
+        try:
+            return search.fit(X, y, rows=rows, balanced=balanced)
+        finally:
+            release_matrix(X)
+    if rows is None:
+        rows = np.arange(len(y))
+    rows = np.asarray(rows)
+    cv, refit = search.cv, search.refit
+    splitter = check_cv(cv, y[rows], classifier=True)
+    folds = [
+        (rows[train], rows[test])
+        for train, test in splitter.split(np.zeros((len(rows), 1)), y[rows])
+    ]
+    fit_params = {}
+    if balanced:
+        # GridSearchCV slices the weights of every training fold. The weight
+        # of a row only depends on its class, so repeated rows agree.
+        sample_weight = np.zeros(len(y))
+        sample_weight[rows] = compute_sample_weight("balanced", y[rows])
+        fit_params["sample_weight"] = sample_weight
+    search.set_params(cv=folds, refit=False)
+    try:
+        search.fit(X, y, **fit_params)
+        if refit:
+            search.best_estimator_ = clone(search.estimator).set_params(
+                **search.best_params_
+            )
+            fit_balanced(search.best_estimator_, X[rows], y[rows], balanced)
+    finally:
+        search.set_params(cv=cv, refit=refit)
+        release_matrix(X)
+    return search
+
+
+# A search is run once per experiment: its winner and CV scores are kept next
+# to the model, so refits on more data (all of exp1, the final model) can
+# reuse them instead of repeating the whole search.
+
+
+def search_results(search):
+    """Best parameters and CV scores of a fitted HalvingSearch or
+    GridSearchCV, as a JSON-serializable dict."""
+    if isinstance(search, HalvingSearch):
+        cv_results = search.cv_results_
+    else:
+        cv_results = [
+            {"params": params, "mean_test_score": score}
+            for params, score in zip(
+                search.cv_results_["params"], search.cv_results_["mean_test_score"]
+            )
+        ]
+    return json.loads(
+        json.dumps(
+            {
+                "best_params": search.best_params_,
+                "best_score": search.best_score_,
+                "cv_results": cv_results,
+            },
+            default=lambda value: value.item(),
+        )
+    )
+
+
+def save_search(results, path):
+    with open(path, "w") as handle:
+        json.dump(results, handle, indent=2)
+
+
+def load_search(path):
+    with open(path) as handle:
+        return json.load(handle)
+
+
+def narrow_grid(param_grid, best_params):
+    """Grid around the best parameters of a previous search: every
+    parameter keeps its best value and its neighbours in the original list.
+    Parameters absent from best_params keep all their values."""
+    narrow = {}
+    for key, values in param_grid.items():
+        values = list(values)
+        matches = [i for i, value in enumerate(values) if value == best_params.get(key)]
+        if len(matches) == 0:
+            narrow[key] = values
+        else:
+            narrow[key] = values[max(matches[0] - 1, 0) : matches[0] + 2]
+    return narrow
+
+
+def refit_params(estimator, params, X, y, rows=None, balanced=False):
+    """Fit estimator with given parameters on X[rows], y[rows], no search."""
+    estimator = clone(estimator).set_params(**params)
+    y = np.asarray(y)
+    if rows is not None:
+        X, y = X[rows], y[rows]
+    return fit_balanced(estimator, X, y, balanced)
@@ -0,0 +1,663 @@
+import os
+import json
+import pickle
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from maldi_preprocess import peak_matrix, bin_spectra
+
+# Small per-sample table stored next to the spectra matrices
+METADATA_COLUMNS = ["id", "label", "experiment", "medio", "semana", "grupo"]
+
+# Intensities are kept in float32 unless float64 is asked for explicitly
+DEFAULT_DTYPE = np.float32
+
+# Rows per chunk of compressed (archival) stores
+CHUNK_ROWS = 1024
+
+
+def load_matrix(path, name, mode="r"):
+    """Open ``name.npy`` memory-mapped, or decompress the chunks of ``name.npz``."""
+    filename = os.path.join(path, name + ".npy")
+    if os.path.exists(filename):
+        return np.load(filename, mmap_mode=mode)
+    with np.load(os.path.join(path, name + ".npz")) as chunks:
+        return np.concatenate([chunks[str(k)] for k in range(len(chunks.files))])
+
+
+def materialize(matrix, rows=None, scale=1.0, dtype=None):
+    """Copy (some rows of) a memory-mapped matrix into memory, scaled.
+
+    The dtype conversion and the scaling are done in one pass over a single
+    new array, instead of a copy for each operation.
+    """
+    if dtype is None:
+        dtype = matrix.dtype
+    if rows is not None:
+        rows = np.asarray(rows, dtype=int)
+        if len(rows) > 0 and np.all(np.diff(rows) == 1):
+            matrix = matrix[rows[0] : rows[-1] + 1]
+        else:
+            out = np.asarray(matrix[rows], dtype=dtype)
+            if scale != 1:
+                out *= scale
+            return out
+    out = np.empty(matrix.shape, dtype=dtype)
+    np.multiply(matrix, scale, out=out, casting="unsafe")
+    return out
+
+
+class SpectrumStore(object):
+    """On-disk columnar MALDI dataset.
+
+    A store is a folder with two contiguous matrices, ``intensities.npy`` and
+    ``masses.npy`` (n_samples x n_features), that are opened memory-mapped,
+    plus a small ``metadata.pkl`` table with one row per sample. Spectra
+    binned on a common m/z grid store the grid once as ``mz.npy`` instead of
+    the masses matrix.
+
+    Intensities are float32 by default. A scaling factor (e.g. the 1e4 the
+    models are trained with) is kept in ``store.json`` and only applied when
+    data is materialized with read(). Archival stores can keep compressed
+    chunks (``intensities.npz``) instead; those are decompressed on load.
+
+    Parameters
+    ----------
+    __path: str.
+        Folder of the store.
+    __mode: str, (default "r").
+        Memory-map mode passed to np.load ("r", "r+" or "c").
+    """
+
+    def __init__(self, path, mode="r"):
+        self.path = path
+        self.mode = mode
+        with open(os.path.join(path, "store.json")) as handle:
+            self.info = json.load(handle)
+        self.intensities = load_matrix(path, "intensities", mode=mode)
+        if self.info.get("mz_grid", False):
+            self.mz = np.load(os.path.join(path, "mz.npy"))
+            # Read-only view with the shape of a masses matrix, no storage
+            self.masses = np.broadcast_to(self.mz, self.intensities.shape)
+        else:
+            self.masses = load_matrix(path, "masses", mode=mode)
+            self.mz = np.mean(self.masses, axis=0)
+        self.metadata = pd.read_pickle(os.path.join(path, "metadata.pkl"))
+
+    def __len__(self):
+        return self.intensities.shape[0]
+
+    @property
+    def shape(self):
+        return self.intensities.shape
+
+    @property
+    def ids(self):
+        return self.metadata["id"].to_numpy()
+
+    @property
+    def labels(self):
+        return self.metadata["label"].to_numpy()
+
+    @property
+    def scale(self):
+        return self.info.get("scale", 1.0)
+
+    def read(self, rows=None, dtype=None):
+        """Intensities in memory with the stored scale applied.
+
+        Parameters
+        ----------
+        __rows: array, (default None).
+            Rows to read, all of them if None.
+        __dtype: dtype, (default None).
+            Output dtype, the one of the store if None.
+        """
+        return materialize(self.intensities, rows, self.scale, dtype)
+
+    def read_peaks(self, rows=None, **kwargs):
+        """Detected peaks as a scaled CSR matrix on the m/z grid.
+
+        The store is screened chunk by chunk, the dense matrix is never
+        materialized. kwargs (half_window_size, snr) go to peak_matrix.
+        """
+        return peak_matrix(self.intensities, scale=self.scale, rows=rows, **kwargs)
+
+    def rows(self, start, stop=None):
+        """Zero-copy view of a contiguous block of samples."""
+        if stop is None:
+            start, stop = 0, start
+        return self.intensities[start:stop], self.masses[start:stop]
+
+    def columns(self, start, stop):
+        """Zero-copy (strided) view of a block of m/z features."""
+        return self.intensities[:, start:stop], self.masses[:, start:stop]
+
+    def take(self, idx):
+        """Gather an arbitrary set of samples (this copies the selected rows)."""
+        idx = np.asarray(idx)
+        return (
+            self.intensities[idx],
+            self.masses[idx],
+            self.metadata.iloc[idx].reset_index(drop=True),
+        )
+
+    def where(self, **query):
+        """Row indices whose metadata matches every ``column=value`` given."""
+        mask = np.ones(len(self), bool)
+        for column, value in query.items():
+            mask &= (self.metadata[column] == value).values
+        return np.flatnonzero(mask)
+
+
+class SpectrumView(object):
+    """A subset of the samples of a SpectrumStore, given by row indices.
+
+    Nothing is copied until the matrices are accessed. A contiguous block of
+    rows is returned as a zero-copy slice of the memory-mapped store.
+    """
+
+    def __init__(self, store, rows):
+        self.store = store
+        self.rows = np.asarray(rows, dtype=int)
+        self.mz = store.mz
+
+    def __len__(self):
+        return len(self.rows)
+
+    @property
+    def shape(self):
+        return (len(self.rows), self.store.intensities.shape[1])
+
+    def select(self, matrix):
+        rows = self.rows
+        if len(rows) > 0 and np.all(np.diff(rows) == 1):
+            return matrix[rows[0] : rows[-1] + 1]
+        return matrix[rows]
+
+    @property
+    def intensities(self):
+        return self.select(self.store.intensities)
+
+    @property
+    def masses(self):
+        return self.select(self.store.masses)
+
+    @property
+    def metadata(self):
+        return self.store.metadata.iloc[self.rows].reset_index(drop=True)
+
+    @property
+    def ids(self):
+        return self.store.ids[self.rows]
+
+    @property
+    def labels(self):
+        return self.store.labels[self.rows]
+
+    def read(self, dtype=None):
+        return self.store.read(self.rows, dtype=dtype)
+
+    def read_peaks(self, **kwargs):
+        return self.store.read_peaks(self.rows, **kwargs)
+
+
+class BatchIterator(object):
+    """Fixed-size batches of spectra read from disk, for bounded memory.
+
+    Only one batch is in memory at a time: every batch is copied out of the
+    memory-mapped matrix with the store scale applied and cast to dtype.
+    Iterating again starts a new pass (epoch), with a new permutation of the
+    rows if shuffle is set. Rows of a batch are read in increasing order so
+    the disk is scanned forwards.
+
+    Parameters
+    ----------
+    __data: SpectrumStore, SpectrumView, array or sparse matrix.
+        Spectra to iterate over (shape = [n_samples, n_features]).
+    __batch_size: int, (default 256).
+        Number of spectra per batch, the last one may be smaller.
+    __shuffle: bool, (default False).
+        Visit the rows in a random order.
+    __labels: array, (default None).
+        If given, batches are (x, y) pairs.
+    __return_index: bool, (default False).
+        Also yield the positions of the batch rows in data, first.
+    __dtype: dtype, (default DEFAULT_DTYPE).
+        dtype of the batches.
+    __random_state: int, (default None).
+        Seed of the permutations.
+    """
+
+    def __init__(
+        self,
+        data,
+        batch_size=256,
+        shuffle=False,
+        labels=None,
+        return_index=False,
+        dtype=DEFAULT_DTYPE,
+        random_state=None,
+    ):
+        if isinstance(data, SpectrumStore):
+            self.matrix, self.rows, self.scale = (
+                data.intensities,
+                np.arange(len(data)),
+                data.scale,
+            )
+        elif isinstance(data, SpectrumView):
+            self.matrix, self.rows, self.scale = (
+                data.store.intensities,
+                data.rows,
+                data.store.scale,
+            )
+        else:
+            self.matrix, self.rows, self.scale = data, np.arange(data.shape[0]), 1.0
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.labels = None if labels is None else np.asarray(labels)
+        self.return_index = return_index
+        self.dtype = dtype
+        self.rng = np.random.default_rng(random_state)
+
+    def __len__(self):
+        return -(-len(self.rows) // self.batch_size)
+
+    @property
+    def shape(self):
+        return (len(self.rows), self.matrix.shape[1])
+
+    def __iter__(self):
+        if self.shuffle:
+            order = self.rng.permutation(len(self.rows))
+        else:
+            order = np.arange(len(self.rows))
+        for start in range(0, len(order), self.batch_size):
+            idx = np.sort(order[start : start + self.batch_size])
+            if sparse.issparse(self.matrix):
+                x = (self.matrix[self.rows[idx]] * self.scale).astype(self.dtype)
+            else:
+                x = materialize(self.matrix, self.rows[idx], self.scale, self.dtype)
+            batch = (x,) if self.labels is None else (x, self.labels[idx])
+            if self.return_index:
+                batch = (idx,) + batch
+            yield batch if len(batch) > 1 else x
+
+
+def predict_in_batches(model, data, batch_size=256):
+    """model.predict and model.predict_proba of data, one batch at a time.
+
+    Returns the predicted classes and probabilities, as if the whole matrix
+    had been passed at once.
+    """
+    pred, proba = [], []
+    for x in BatchIterator(data, batch_size=batch_size):
+        pred.append(model.predict(x))
+        proba.append(model.predict_proba(x))
+    return np.concatenate(pred), np.vstack(proba)
+
+
+def metadata_frame(metadata):
+    """Per-sample metadata as a DataFrame, missing METADATA_COLUMNS filled
+    with None."""
+    metadata = pd.DataFrame(metadata).reset_index(drop=True)
+    for column in METADATA_COLUMNS:
+        if column not in metadata.columns:
+            metadata[column] = None
+    return metadata
+
+
+def write_store(
+    path,
+    intensities,
+    masses,
+    metadata,
+    mz=None,
+    dtype=DEFAULT_DTYPE,
+    scale=1.0,
+    compress=False,
+):
+    """Write a spectra dataset as a SpectrumStore folder.
+
+    Parameters
+    ----------
+    __path: str.
+        Destination folder, created if it does not exist.
+    __intensities: array or list of arrays (shape = [n_samples, n_features]).
+        Intensity of each spectrum. Rows are written one at a time so a list
+        of per-sample arrays is never stacked in memory.
+    __masses: array or list of arrays (shape = [n_samples, n_features]).
+        m/z axis of each spectrum. Ignored when mz is given.
+    __metadata: DataFrame or dict.
+        Per-sample columns. Missing METADATA_COLUMNS are filled with None.
+    __mz: array (shape = [n_features,]), (default None).
+        Common m/z grid of binned spectra, stored once for the whole dataset.
+    __dtype: dtype, (default np.float32).
+        dtype of the intensities on disk. m/z values are always float64.
+    __scale: float, (default 1.0).
+        Factor applied by SpectrumStore.read(), the data is stored unscaled.
+    __compress: bool, (default False).
+        Write compressed chunks of CHUNK_ROWS rows instead of memory-mappable
+        matrices. Compressed stores are read-only archives.
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    metadata = metadata_frame(metadata)
+
+    n_samples = len(metadata)
+    n_features = len(intensities[0])
+    matrices = [("intensities", intensities)]
+    if mz is None:
+        matrices.append(("masses", masses))
+    else:
+        np.save(os.path.join(path, "mz.npy"), np.asarray(mz, dtype=np.float64))
+    for name, values in matrices:
+        matrix_dtype = dtype if name == "intensities" else np.float64
+        if compress:
+            chunks = {}
+            for start in range(0, n_samples, CHUNK_ROWS):
+                stop = min(start + CHUNK_ROWS, n_samples)
+                chunks[str(len(chunks))] = np.array(
+                    [values[i] for i in range(start, stop)], dtype=matrix_dtype
+                )
+            np.savez_compressed(os.path.join(path, name + ".npz"), **chunks)
+            continue
+        out = np.lib.format.open_memmap(
+            os.path.join(path, name + ".npy"),
+            mode="w+",
+            dtype=matrix_dtype,
+            shape=(n_samples, n_features),
+        )
+        for i in range(n_samples):
+            out[i] = values[i]
+        out.flush()
+        del out
+
+    metadata.to_pickle(os.path.join(path, "metadata.pkl"))
+    with open(os.path.join(path, "store.json"), "w") as handle:
+        json.dump(
+            {
+                "n_samples": n_samples,
+                "n_features": n_features,
+                "mz_grid": mz is not None,
+                "dtype": np.dtype(dtype).name,
+                "scale": scale,
+                "compressed": compress,
+            },
+            handle,
+        )
+
+    return SpectrumStore(path)
+
+
+def load_store(path, mode="r"):
+    return SpectrumStore(path, mode=mode)
+
+
+def store_matrices(path):
+    info = SpectrumStore(path).info
+    if info.get("compressed", False):
+        raise ValueError("Compressed stores are read-only: " + path)
+    if info.get("mz_grid", False):
+        return ["intensities"]
+    return ["intensities", "masses"]
+
+
+def write_info(path, **info):
+    with open(os.path.join(path, "store.json")) as handle:
+        stored = json.load(handle)
+    stored.update(info)
+    with open(os.path.join(path, "store.json"), "w") as handle:
+        json.dump(stored, handle)
+
+
+def resize_rows(filename, n_rows):
+    """Grow or shrink the first axis of a .npy file in place.
+
+    Only the header and the end of the file are touched. np.save leaves room
+    in the header for the first dimension to grow, so no data is moved.
+    """
+    with open(filename, "r+b") as handle:
+        version = np.lib.format.read_magic(handle)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(handle)
+            prefix = 10
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(handle)
+            prefix = 12
+        offset = handle.tell()
+        shape = (n_rows,) + tuple(shape[1:])
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+            np.lib.format.dtype_to_descr(dtype),
+            shape,
+        )
+        space = offset - prefix - 1
+        if len(header) > space:
+            raise ValueError("No room left in the header of " + filename)
+        handle.seek(prefix)
+        handle.write((header.ljust(space) + "\n").encode("latin1"))
+        handle.truncate(offset + int(np.prod(shape)) * dtype.itemsize)
+
+
+def append_rows(path, intensities, metadata, masses=None):
+    """Append samples at the end of an existing store, in place.
+
+    Missing METADATA_COLUMNS are filled with None, as in write_store.
+    """
+    metadata = metadata_frame(metadata)
+    n_old = len(SpectrumStore(path))
+    n_new = n_old + len(metadata)
+    values = {"intensities": intensities, "masses": masses}
+    for name in store_matrices(path):
+        filename = os.path.join(path, name + ".npy")
+        resize_rows(filename, n_new)
+        out = np.load(filename, mmap_mode="r+")
+        for i in range(n_new - n_old):
+            out[n_old + i] = values[name][i]
+        out.flush()
+        del out
+
+    stored = pd.read_pickle(os.path.join(path, "metadata.pkl"))
+    stored = pd.concat([stored, metadata], ignore_index=True)
+    stored.to_pickle(os.path.join(path, "metadata.pkl"))
+    write_info(path, n_samples=n_new)
+
+
+def replace_rows(path, rows, intensities, metadata, masses=None):
+    """Overwrite the given samples of a store, in place."""
+    rows = np.asarray(rows, dtype=int)
+    metadata = pd.DataFrame(metadata).reset_index(drop=True)
+    values = {"intensities": intensities, "masses": masses}
+    for name in store_matrices(path):
+        out = np.load(os.path.join(path, name + ".npy"), mmap_mode="r+")
+        for i, row in enumerate(rows):
+            out[row] = values[name][i]
+        out.flush()
+        del out
+
+    stored = pd.read_pickle(os.path.join(path, "metadata.pkl"))
+    for column in metadata.columns:
+        stored.loc[rows, column] = metadata[column].values
+    stored.to_pickle(os.path.join(path, "metadata.pkl"))
+
+
+def delete_rows(path, rows):
+    """Remove samples from a store, in place.
+
+    Each removed row is filled with one of the last rows and the files are
+    truncated, so the cost depends on the number of removed rows only. The
+    order of the remaining rows changes, and so does the revision of the
+    store (splits written before are no longer valid, see load_split).
+
+    Returns perm, the old row index of every row of the updated store.
+    """
+    n = len(SpectrumStore(path))
+    perm = list(range(n))
+    for row in sorted(set(int(row) for row in rows), reverse=True):
+        perm[row] = perm[-1]
+        perm.pop()
+    perm = np.array(perm, dtype=int)
+
+    # Sources are always rows past the new end, so no row is overwritten
+    # before being moved
+    moved = np.flatnonzero(perm != np.arange(len(perm)))
+    for name in store_matrices(path):
+        filename = os.path.join(path, name + ".npy")
+        out = np.load(filename, mmap_mode="r+")
+        out[moved] = out[perm[moved]]
+        out.flush()
+        del out
+        resize_rows(filename, len(perm))
+
+    stored = pd.read_pickle(os.path.join(path, "metadata.pkl"))
+    stored.iloc[perm].reset_index(drop=True).to_pickle(
+        os.path.join(path, "metadata.pkl")
+    )
+    info = SpectrumStore(path).info
+    write_info(path, n_samples=len(perm), revision=info.get("revision", 0) + 1)
+    return perm
+
+
+def store_fingerprint(store):
+    """Number of rows and revision of the store. Appending rows only changes
+    the number of rows; delete_rows, which moves rows around, bumps the
+    revision."""
+    return {"n_samples": len(store), "revision": store.info.get("revision", 0)}
+
+
+def write_split(path, name, partitions, raw=None):
+    """Store a train/test (or CV fold) split as an index file of a store.
+
+    Only the row indices and the isolate ids of each partition are written,
+    to ``splits/<name>.json`` inside the store, so any number of splits can
+    share the same spectra. The fingerprint of the store (see
+    store_fingerprint) is kept under "store" to detect later updates.
+
+    Parameters
+    ----------
+    __path: str.
+        Folder of the store.
+    __name: str.
+        Name of the split, e.g. "exp1".
+    __partitions: dict.
+        Partition name ("train", "test", ...) to row indices of the store.
+    __raw: dict, (default None).
+        Optional partition name to list of raw acquisition folders.
+    """
+    store = SpectrumStore(path)
+    split = {"store": store_fingerprint(store)}
+    for part, rows in partitions.items():
+        rows = np.sort(np.asarray(rows, dtype=int))
+        split[part] = {"rows": rows.tolist(), "ids": store.ids[rows].tolist()}
+        if raw is not None and part in raw:
+            split[part]["raw"] = list(raw[part])
+    if not os.path.exists(os.path.join(path, "splits")):
+        os.makedirs(os.path.join(path, "splits"))
+    with open(os.path.join(path, "splits", name + ".json"), "w") as handle:
+        json.dump(split, handle)
+
+
+def load_split(path, name, mode="r"):
+    """Partitions of a split as SpectrumViews over one shared store.
+
+    The split is checked against the fingerprint of the store. Rows appended
+    since it was written (e.g. new replicates) are reported and left out;
+    if rows were deleted or moved a ValueError is raised and the split has
+    to be written again, it is never re-derived from the ids.
+    """
+    store = SpectrumStore(path, mode=mode)
+    with open(os.path.join(path, "splits", name + ".json")) as handle:
+        split = json.load(handle)
+    fingerprint = split.pop("store", None)
+    if fingerprint is None:
+        # Written before the fingerprint was kept, only the ids can be checked
+        print("Warning: split " + name + " has no store fingerprint")
+    elif (
+        fingerprint["n_samples"] > len(store)
+        or fingerprint["revision"] != store_fingerprint(store)["revision"]
+    ):
+        raise ValueError(
+            "Rows of the store were deleted or moved since split "
+            + name
+            + " was written, write the split again"
+        )
+    elif fingerprint["n_samples"] < len(store):
+        print(
+            "Warning:",
+            len(store) - fingerprint["n_samples"],
+            "rows were appended to the store since split",
+            name,
+            "was written, they are not in it",
+        )
+    store_ids = store.ids
+    views = {}
+    for part, index in split.items():
+        rows = np.asarray(index["rows"], dtype=int)
+        ids = np.asarray(index["ids"], dtype=store_ids.dtype)
+        if np.any(rows >= len(store)) or np.any(store_ids[rows] != ids):
+            raise ValueError(
+                "The rows of split " + name + " no longer hold its samples"
+            )
+        views[part] = SpectrumView(store, rows)
+    return views
+
+
+def write_cv_splits(path, name, n_splits=5):
+    """K folds grouped by isolate id, written as splits name_fold0, ..."""
+    from sklearn.model_selection import GroupKFold
+
+    store = SpectrumStore(path)
+    folds = GroupKFold(n_splits=n_splits).split(store.ids, groups=store.ids)
+    for k, (train, test) in enumerate(folds):
+        write_split(path, name + "_fold" + str(k), {"train": train, "test": test})
+
+
+def pickle_to_store(pkl_path, path, experiment=None, bin_kwargs=None, **kwargs):
+    """Convert one of the legacy pickles (data_expX.pkl, data_final.pkl or a
+    df_*_exp2.pkl DataFrame) into a SpectrumStore.
+
+    The legacy spectra are on their truncated raw m/z axis: they are
+    resampled with bin_spectra (bin_kwargs: mz_min, mz_max, bin_width,
+    method) and stored with the common grid, the features predict.py uses.
+
+    For pickles holding several partitions ("train"/"test") one store per
+    partition is written as ``path + "_" + partition``. Extra keyword
+    arguments (dtype, scale, compress) are passed to write_store.
+    """
+    with open(pkl_path, "rb") as handle:
+        data = pickle.load(handle)
+
+    if isinstance(data, pd.DataFrame):
+        metadata = {
+            "id": data["id"].values,
+            "label": data["label"].values,
+            "experiment": experiment,
+        }
+        mz, binned = bin_spectra(
+            list(data["mz"].values),
+            list(data["intensity"].values),
+            **(bin_kwargs or {})
+        )
+        return write_store(path, binned, None, metadata, mz=mz, **kwargs)
+
+    if "intensities" not in data:
+        return [
+            pickle_to_store_dict(
+                data[key], path + "_" + key, experiment, bin_kwargs, **kwargs
+            )
+            for key in data.keys()
+        ]
+    return pickle_to_store_dict(data, path, experiment, bin_kwargs, **kwargs)
+
+
+def pickle_to_store_dict(data, path, experiment=None, bin_kwargs=None, **kwargs):
+    metadata = {
+        "id": np.asarray(data["ids"]).ravel(),
+        "label": np.asarray(data["labels"]).ravel(),
+        "experiment": experiment,
+    }
+    mz, binned = bin_spectra(
+        list(data["masses"]), list(data["intensities"]), **(bin_kwargs or {})
+    )
+    return write_store(path, binned, None, metadata, mz=mz, **kwargs)
@@ -0,0 +1,36 @@
+import io
+import contextlib
+import numpy as np
+import pytest
+from dblrfs import DBL_class
+
+
+def primal_data(seed=0, n=350, k=60):
+    # Fewer features than samples: LR_ARD solves in the primal
+    rng = np.random.RandomState(seed)
+    x = rng.randn(n, k)
+    y = (x[:, :3].sum(axis=1) + rng.randn(n) > 0).astype(int)[:, np.newaxis]
+    return np.hstack((x, np.ones((n, 1)))), y
+
+
+@pytest.mark.parametrize("multi", [False, True])
+@pytest.mark.parametrize("maxit", [5, 6, 7])
+def test_pruning_in_the_primal(multi, maxit):
+    # Pruning on the last iterations must keep W consistent with z, so that
+    # the posterior can be mapped back to A after fit
+    x, y = primal_data()
+    if multi:
+        model, y = DBL_class.MultiLR_ARD(), np.hstack((y, 1 - y))
+    else:
+        model = DBL_class.LR_ARD()
+    with contextlib.redirect_stdout(io.StringIO()):
+        model.fit(
+            x[:300], y[:300], x[300:], y[300:], prune=1, maxit=maxit, pruning_crit=0.1
+        )
+    assert model.primal
+    k = model.z.shape[1]
+    assert model.q_dist.W["mean"].shape[0] == k
+    assert model.q_dist.A["mean"].shape[0] == 300
+    probs = model.predict_proba_th(x[300:][:, model.index], 0.08)
+    assert probs.shape == (50, y.shape[1])
+    assert np.all(np.isfinite(probs))
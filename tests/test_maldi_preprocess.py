@@ -0,0 +1,26 @@
+import numpy as np
+from maldi_preprocess import bin_spectra, mz_grid
+
+
+def tof_axis(n_points=15000, mz_min=2000, mz_max=20500):
+    # Raw Bruker points are evenly spaced in time of flight, i.e. in sqrt(m/z),
+    # and more than 1 Da apart at the high end
+    return np.linspace(np.sqrt(mz_min), np.sqrt(mz_max), n_points) ** 2
+
+
+def test_flat_spectrum_bins_flat():
+    mass = tof_axis()
+    assert np.diff(mass).max() > 1
+    mz, binned = bin_spectra([mass], [np.ones_like(mass)])
+    np.testing.assert_array_equal(mz, mz_grid())
+    np.testing.assert_allclose(binned, 1)
+
+
+def test_spectra_of_different_axes_in_one_batch():
+    short, long = tof_axis(5000, 2000, 8000), tof_axis()
+    mz, binned = bin_spectra([long, short], [3 * np.ones_like(long), short])
+    np.testing.assert_allclose(binned[0], 3)
+    # Linear data is interpolated exactly, bins beyond the spectrum are empty
+    inside = mz <= short[-1]
+    np.testing.assert_allclose(binned[1, inside], mz[inside], rtol=1e-12)
+    assert np.all(binned[1, ~inside] == 0)